@@ -0,0 +1,52 @@
+"""In-process TTL cache for small, hot lookups"""
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """Bounded mapping whose entries expire `ttl` seconds after being set.
+
+    Expired entries are swept on every set; when still full, the oldest entry
+    is evicted. Not thread-safe; meant to be used from a single event loop.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            del self._data[key]
+            return default
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        now = time.monotonic()
+        # The TTL is constant, so insertion order is expiry order: expired
+        # entries are all at the front
+        while self._data:
+            oldest = next(iter(self._data))
+            if self._data[oldest][0] > now:
+                break
+            del self._data[oldest]
+        if key in self._data:
+            del self._data[key]
+        elif len(self._data) >= self.maxsize:
+            self._data.popitem(last=False)
+        self._data[key] = (now + self.ttl, value)
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
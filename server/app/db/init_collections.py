@@ -8,6 +8,7 @@ import os
 import uuid
 import json
 from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
 from datetime import datetime, timezone
 import logging
 from typing import Dict, List, Any
@@ -61,6 +62,9 @@ JSON_SCHEMAS = {
     "audio_files": load_json_schema("audio_files"),
 }
 
+# Collation shared by the username_ci index and the users search query
+USERNAME_SEARCH_COLLATION = {"locale": "en", "strength": 2}
+
 # Collection Schema Definitions
 COLLECTIONS_CONFIG = {
     "users": {
@@ -68,6 +72,8 @@ COLLECTIONS_CONFIG = {
             {"fields": "id", "unique": True},
             {"fields": "email", "unique": True},
             {"fields": "username", "unique": False},  # Allow duplicate usernames (including empty)
+            # Case-insensitive copy for prefix search; queries must pass the same collation
+            {"fields": "username", "unique": False, "name": "username_ci", "collation": USERNAME_SEARCH_COLLATION},
             {"fields": "created_at", "unique": False},
             {"fields": "last_login", "unique": False}
         ],
@@ -76,9 +82,12 @@ COLLECTIONS_CONFIG = {
     "threads": {
         "indexes": [
             {"fields": "id", "unique": True},
-            {"fields": "users.id", "unique": False},
+            # Thread listing order (updated_at, id tiebreak); also serves
+            # plain users.id lookups (index prefix)
+            {"fields": [("users.id", ASCENDING), ("updated_at", DESCENDING), ("id", DESCENDING)], "unique": False},
             {"fields": "created_at", "unique": False},
-            {"fields": "updated_at", "unique": False}
+            # Unfiltered thread listing order
+            {"fields": [("updated_at", DESCENDING), ("id", DESCENDING)], "unique": False}
         ],
         "schema": {k: v for k, v in JSON_SCHEMAS.get("threads", {}).get("properties", {}).items()}
     },
@@ -94,9 +103,13 @@ COLLECTIONS_CONFIG = {
     "messages": {
         "indexes": [
             {"fields": "id", "unique": True},
-            {"fields": "parent_thread", "unique": False},
+            # Also serves plain parent_thread lookups/deletes (index prefix)
             {"fields": [("parent_thread", ASCENDING), ("timestamp", ASCENDING)], "unique": False},
-            {"fields": "user_id", "unique": False},
+            # Direct-message history: each $or branch (sender, recipient) is an
+            # index range already sorted newest first; also serves plain
+            # user_id lookups (index prefix)
+            {"fields": [("user_id", ASCENDING), ("metadata.to", ASCENDING),
+                        ("parent_thread", ASCENDING), ("created_at", DESCENDING)], "unique": False},
             {"fields": "created_at", "unique": False}
         ],
         "schema": {k: v for k, v in JSON_SCHEMAS.get("messages", {}).get("properties", {}).items()}
@@ -108,7 +121,13 @@ COLLECTIONS_CONFIG = {
             {"fields": "content_hash", "unique": True},  # Primary deduplication
             {"fields": "s3_key", "unique": False},
             {"fields": "created_at", "unique": False},
-            {"fields": "reference_count", "unique": False}
+            # Cleanup candidates (reference_count = 0, created_at < cutoff);
+            # only unreferenced files are indexed
+            {"fields": [("reference_count", ASCENDING), ("created_at", ASCENDING)], "unique": False,
+             "partialFilterExpression": {"reference_count": 0}},
+            # Retry queue for failed S3 deletes; only flagged files are indexed
+            {"fields": "pending_deletion", "unique": False,
+             "partialFilterExpression": {"pending_deletion": True}}
         ],
         "schema": {k: v for k, v in JSON_SCHEMAS.get("audio_files", {}).get("properties", {}).items()}
     }
@@ -263,6 +282,13 @@ def init_mongodb(drop_existing: bool = False, insert_samples: bool = True):
         logger.error(f"❌ Error initializing MongoDB: {e}")
         raise
 
+# Indexes that earlier versions created and that are now covered by a compound
+# index prefix; dropped on existing databases so writes stop maintaining them
+OBSOLETE_INDEXES = {
+    "threads": ["users.id_1"],
+    "messages": ["parent_thread_1"],
+}
+
 def create_collections_and_indexes(db):
     """Create collections and their indexes based on configuration"""
     
@@ -275,21 +301,32 @@ def create_collections_and_indexes(db):
         for index_config in config["indexes"]:
             fields = index_config["fields"]
             unique = index_config.get("unique", False)
+            # Optional name/collation (needed when a key pattern is indexed twice)
+            # and partial filter
+            options = {k: index_config[k] for k in ("name", "collation", "partialFilterExpression") if k in index_config}
             
             try:
                 if isinstance(fields, str):
                     # Single field index
-                    collection.create_index(fields, unique=unique)
+                    collection.create_index(fields, unique=unique, **options)
                 elif isinstance(fields, list):
                     # Compound index
-                    collection.create_index(fields, unique=unique)
+                    collection.create_index(fields, unique=unique, **options)
                 
-                index_name = fields if isinstance(fields, str) else str(fields)
+                index_name = options.get("name") or (fields if isinstance(fields, str) else str(fields))
                 logger.info(f"  ✅ Index created: {index_name}")
                 
             except Exception as e:
                 logger.warning(f"  ⚠️  Index creation failed for {fields}: {e}")
         
+        for index_name in OBSOLETE_INDEXES.get(collection_name, []):
+            try:
+                collection.drop_index(index_name)
+                logger.info(f"  🗑️  Obsolete index dropped: {index_name}")
+            except OperationFailure:
+                # IndexNotFound: fresh database or already dropped
+                pass
+        
         # Log schema info
         schema_fields = list(config["schema"].keys())
         logger.info(f"  📋 Schema fields: {schema_fields}")
@@ -13,20 +13,19 @@ from datetime import datetime
 from fastapi import Request, Query, HTTPException, Body, UploadFile, File, Form
 from typing import Optional, Dict, Any
 from bson import ObjectId
+from pymongo import ReturnDocument
 from db.connection import get_database
+from http_api.auth import verify_token
 from storage.s3_service import get_s3_service
 
 logger = logging.getLogger(__name__)
 
-API_TOKEN = os.getenv("API_TOKEN")
+# Read size when hashing uploads
+UPLOAD_HASH_CHUNK_SIZE = 1024 * 1024
 
 def get_db():
     return get_database()
 
-def verify_token(token: str):
-    if token != API_TOKEN:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-
 
 # =============================================================================
 # UPLOAD HANDLER
@@ -44,7 +43,7 @@ async def upload_audio_handler(
     Upload audio file with content-based addressing
     
     Flow:
-    1. Read file content
+    1. Stream file content
     2. Calculate SHA-256 hash
     3. Use hash as S3 key: prod/audio/{hash}.{format}
     4. Check if already exists in S3
@@ -54,12 +53,14 @@ async def upload_audio_handler(
     verify_token(token)
     
     try:
-        # Read file content
-        file_data = await file.read()
-        file_size = len(file_data)
-        
-        # Calculate content hash (SHA-256)
-        content_hash = hashlib.sha256(file_data).hexdigest()
+        # Calculate content hash (SHA-256) and size a chunk at a time, so the
+        # upload is never buffered whole in memory
+        hasher = hashlib.sha256()
+        file_size = 0
+        while chunk := await file.read(UPLOAD_HASH_CHUNK_SIZE):
+            hasher.update(chunk)
+            file_size += len(chunk)
+        content_hash = hasher.hexdigest()
         
         # Construct S3 key using hash (new path structure)
         env = os.getenv("ENV", "prod")  # prod or stage
@@ -70,7 +71,7 @@ async def upload_audio_handler(
         s3_url = s3_service.get_public_url(s3_key)
         
         # Check if file already exists in S3
-        if s3_service.file_exists(s3_key):
+        if await s3_service.afile_exists(s3_key):
             logger.info(f"♻️  Audio already exists in S3: {s3_key}")
             
             # Check if audio_files record exists
@@ -133,8 +134,10 @@ async def upload_audio_handler(
         }
         content_type = content_type_map.get(format, "audio/mpeg")
         
-        uploaded_url = s3_service.upload_file(
-            file_data=file_data,
+        # Stream the spooled upload straight to S3 from the start
+        await file.seek(0)
+        uploaded_url = await s3_service.aupload_file(
+            file_data=file.file,
             file_key=s3_key,
             content_type=content_type
         )
@@ -348,18 +351,27 @@ async def decrement_audio_reference_handler(request: Request, audio_data: Dict[s
         if not audio_id:
             raise HTTPException(status_code=400, detail="audio_id is required")
         
-        # Find the audio file
-        audio = db.audio_files.find_one({"id": audio_id})
+        # Decrement reference count atomically (but not below 0), so
+        # concurrent decrements can't both write back the same stale count
+        projection = {"_id": 0, "id": 1, "url": 1, "s3_key": 1, "reference_count": 1}
+        audio = db.audio_files.find_one_and_update(
+            {"id": audio_id, "reference_count": {"$gt": 0}},
+            {"$inc": {"reference_count": -1}},
+            projection=projection,
+            return_document=ReturnDocument.AFTER
+        )
         if not audio:
-            raise HTTPException(status_code=404, detail=f"Audio file not found: {audio_id}")
+            # Either missing or already at 0
+            audio = db.audio_files.find_one({"id": audio_id}, projection)
+            if not audio:
+                raise HTTPException(status_code=404, detail=f"Audio file not found: {audio_id}")
         
-        # Decrement reference count (but not below 0)
-        new_count = max(0, audio.get("reference_count", 1) - 1)
+        new_count = audio.get("reference_count", 0)
         
         if new_count == 0:
             # AGGRESSIVE: Delete from S3 immediately when unreferenced
             try:
-                s3_deleted = s3_service.delete_file(audio["s3_key"])
+                s3_deleted = await s3_service.adelete_file(audio["s3_key"])
                 
                 if s3_deleted:
                     # Delete from database
@@ -402,12 +414,7 @@ async def decrement_audio_reference_handler(request: Request, audio_data: Dict[s
                     "message": f"S3 deletion failed: {str(e)}"
                 }
         else:
-            # Still referenced - just decrement
-            db.audio_files.update_one(
-                {"id": audio_id},
-                {"$set": {"reference_count": new_count}}
-            )
-            
+            # Still referenced - already decremented above
             return {
                 "id": audio_id,
                 "reference_count": new_count,
@@ -0,0 +1,18 @@
+import os
+import hmac
+import functools
+from fastapi import HTTPException
+
+API_TOKEN = os.getenv("API_TOKEN")
+API_TOKEN_BYTES = (API_TOKEN or "").encode()
+
+@functools.lru_cache(maxsize=1024)
+def _token_ok(token: str) -> bool:
+    # Clients resend the same token on every request, so the compare
+    # (and the encode) runs once per distinct token
+    return hmac.compare_digest(token.encode(), API_TOKEN_BYTES)
+
+def verify_token(token: str):
+    # Constant-time compare; an unset API_TOKEN rejects everything
+    if not API_TOKEN_BYTES or not isinstance(token, str) or not _token_ok(token):
+        raise HTTPException(status_code=401, detail="Unauthorized")
@@ -1,4 +1,5 @@
-from fastapi import APIRouter, Request, Query, Body, UploadFile, File, Form
+from fastapi import APIRouter, Request, Query, Body, UploadFile, File, Form, BackgroundTasks
+from fastapi.responses import JSONResponse
 from typing import Optional
 from http_api.users import (
     login_handler, 
@@ -63,18 +64,19 @@ async def register(request: Request, register_data: RegisterRequest):
     """User registration"""
     return await register_handler(request, register_data)
 
-@router.post("/users/session")
+@router.post("/users/session", response_class=JSONResponse, response_model=None)
 async def session(request: Request, user_data: UserSessionRequest):
     """Get or create a user session"""
     return await session_handler(request, user_data)
 
 # User endpoints (renamed from profile endpoints)
-@router.get("/users/user")
+# Read handlers return JSONResponse directly, as the threads reads do
+@router.get("/users/user", response_class=JSONResponse, response_model=None)
 async def get_user(request: Request, id: str = Query(...), token: str = Query(...)):
     """Get user by ID"""
     return await get_user_handler(request, id, token)
 
-@router.get("/users/list")
+@router.get("/users/list", response_class=JSONResponse, response_model=None)
 async def get_users(request: Request, token: str = Query(...), limit: int = Query(20), offset: int = Query(0)):
     """Get list of users"""
     return await get_users_handler(request, token, limit, offset)
@@ -89,12 +91,12 @@ async def unfollow_user(request: Request, follow_data: Dict[str, Any] = Body(...
     """Unfollow a user"""
     return await unfollow_user_handler(request, follow_data)
 
-@router.get("/users/search")
-async def search_users(request: Request, token: str = Query(...), query: str = Query(...), limit: int = Query(20)):
+@router.get("/users/search", response_class=JSONResponse, response_model=None)
+async def search_users(request: Request, token: str = Query(...), query: str = Query(...), limit: int = Query(20, ge=1)):
     """Search users by username"""
     return await search_users_handler(request, token, query, limit)
 
-@router.get("/users/following")
+@router.get("/users/following", response_class=JSONResponse, response_model=None)
 async def get_followed_users(request: Request, token: str = Query(...), user_id: str = Query(...)):
     """Get users followed by a specific user"""
     return await get_followed_users_handler(request, token, user_id)
@@ -110,23 +112,25 @@ async def remove_from_playlist(request: Request, playlist_data: Dict[str, Any] =
     """Remove a render from user's playlist"""
     return await remove_from_playlist_handler(request, playlist_data)
 
-@router.get("/users/playlist")
+@router.get("/users/playlist", response_class=JSONResponse, response_model=None)
 async def get_playlist(request: Request, token: str = Query(...), user_id: str = Query(...)):
     """Get user's playlist"""
     return await get_playlist_handler(request, token, user_id)
 
-@router.put("/users/{user_id}/username")
-async def update_username(request: Request, user_id: str, username_data: UpdateUsernameRequest):
+@router.put("/users/{user_id}/username", response_class=JSONResponse, response_model=None)
+async def update_username(request: Request, user_id: str, username_data: UpdateUsernameRequest, background_tasks: BackgroundTasks):
     """Update user's username"""
-    return await update_username_handler(request, user_id, username_data)
+    return await update_username_handler(request, user_id, username_data, background_tasks)
 
 # Threads endpoints (new paths)
-@router.get("/threads")
-async def get_threads(request: Request, token: str = Query(...), limit: int = Query(20), offset: int = Query(0), user_id: Optional[str] = Query(None)):
-    """Get list of threads (new path)"""
-    return await get_threads_handler(request, token, limit, offset, user_id)
-
-@router.get("/threads/{thread_id}")
+# Read handlers build their JSONResponse from JSON-safe Mongo documents
+# themselves; response_model=None keeps FastAPI from modelling/encoding them
+@router.get("/threads", response_class=JSONResponse, response_model=None)
+async def get_threads(request: Request, token: str = Query(...), limit: int = Query(20, ge=1), offset: int = Query(0, ge=0), user_id: Optional[str] = Query(None), cursor: Optional[str] = Query(None)):
+    """Get list of threads (new path). Pass pagination.next_cursor as `cursor` to page without offsets."""
+    return await get_threads_handler(request, token, limit, offset, user_id, cursor)
+
+@router.get("/threads/{thread_id}", response_class=JSONResponse, response_model=None)
 async def get_thread_by_path(request: Request, thread_id: str, token: str = Query(...)):
     """Get thread by ID (new path)"""
     return await get_thread_handler(request, thread_id, token)
@@ -155,9 +159,9 @@ async def delete_thread(request: Request, thread_id: str, token: str = Query(...
     return await delete_thread_handler(request, thread_id, token)
 
 @router.post("/threads/{thread_id}/invites")
-async def send_invitation(request: Request, thread_id: str, invitation_data: Dict[str, Any] = Body(...)):
+async def send_invitation(request: Request, thread_id: str, background_tasks: BackgroundTasks, invitation_data: Dict[str, Any] = Body(...)):
     """Send invitation to user for a thread"""
-    return await send_invitation_handler(request, thread_id, invitation_data)
+    return await send_invitation_handler(request, thread_id, background_tasks, invitation_data)
 
 @router.put("/threads/{thread_id}/invites/{user_id}")
 async def manage_invitation(request: Request, thread_id: str, user_id: str, action_data: Dict[str, Any] = Body(...)):
@@ -165,19 +169,19 @@ async def manage_invitation(request: Request, thread_id: str, user_id: str, acti
     return await manage_invitation_handler(request, thread_id, user_id, action_data)
 
 # Messages endpoints
-@router.get("/messages")
+@router.get("/messages", response_class=JSONResponse, response_model=None)
 async def get_messages(
     request: Request,
     thread_id: str = Query(...),
     token: str = Query(...),
-    limit: int = Query(100),
+    limit: int = Query(100, ge=1),
     order: str = Query("asc"),
     include_snapshot: bool = Query(True),
 ):
     """List messages for a thread with optional pagination and projection"""
     return await get_messages_handler(request, thread_id, token, limit, order, include_snapshot)
 
-@router.get("/messages/{message_id}")
+@router.get("/messages/{message_id}", response_class=JSONResponse, response_model=None)
 async def get_message_by_id(
     request: Request,
     message_id: str,
@@ -188,14 +192,18 @@ async def get_message_by_id(
     return await get_message_by_id_handler(request, message_id, token, include_snapshot)
 
 @router.post("/messages")
-async def create_message(request: Request, message_data: Dict[str, Any] = Body(...)):
-    """Create a message (snapshot) for a thread"""
-    return await create_message_handler(request, message_data)
+async def create_message(
+    request: Request,
+    message_data: Dict[str, Any] = Body(...),
+    echo: str = Query("full"),
+):
+    """Create a message (snapshot) for a thread; echo=metadata omits the snapshot from the response"""
+    return await create_message_handler(request, message_data, echo)
 
 @router.delete("/messages/{message_id}")
-async def delete_message(request: Request, message_id: str, token: str = Query(...)):
+async def delete_message(request: Request, message_id: str, background_tasks: BackgroundTasks, token: str = Query(...)):
     """Delete a message by ID"""
-    return await delete_message_handler(request, message_id, token)
+    return await delete_message_handler(request, message_id, background_tasks, token)
 
 @router.post("/messages/{message_id}/renders")
 async def attach_render_to_message(request: Request, message_id: str, render_data: Dict[str, Any] = Body(...)):
@@ -1,98 +1,151 @@
+import re
 import uuid
 import json
 import asyncio
+import itertools
 import logging
 from datetime import datetime, timezone
-from fastapi import Request, Query, HTTPException, Body
+from fastapi import Request, Query, HTTPException, Body, BackgroundTasks
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from typing import Optional, Dict, Any, List
-import os
-from db.connection import get_database
-from ws.router import send_thread_invitation_notification, send_message_created_notification, send_invitation_accepted_notification
+from db.connection import get_async_database
+from http_api.auth import verify_token
+from ws.router import send_thread_invitation_notification, enqueue_message_created, enqueue_invitation_accepted
+from cache.ttl_cache import TTLCache
+from storage.s3_service import get_s3_service
 from bson import ObjectId
 
 logger = logging.getLogger(__name__)
 
-# Initialize database connection
-db = get_database()
+# Database handle (asyncio driver; handlers await every call). Bound by
+# init_db() at app startup, so importing this module doesn't create a client
+# and each worker process builds its own.
+db = None
 
-API_TOKEN = os.getenv("API_TOKEN")
+# Threads keep a capped copy of their latest messages (without snapshots) so
+# opening a thread doesn't need a second query against the messages collection
+RECENT_MESSAGES_CAP = 100
+RECENT_MESSAGES_RETURNED = 50
+# Object key part of a render URL, e.g. https://fortuned.fra1.digitaloceanspaces.com/prod/renders/uuid.mp3 -> prod/renders/uuid.mp3
+S3_KEY_FROM_URL_RE = re.compile(r'\.com/(.+)$')
+# Fields a thread PATCH may set
+THREAD_UPDATABLE_FIELDS = frozenset({"users", "messages", "invites"})
+# Message pages larger than this are streamed doc-by-doc instead of materialized
+STREAM_MESSAGES_OVER = 500
 
-def get_db():
-    return get_database()
+def init_db():
+    """Bind the module's database handle to this process's async client"""
+    set_db(get_async_database())
 
-def verify_token(token: str):
-    if token != API_TOKEN:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+def set_db(database):
+    """Rebind the module's database handle (e.g. to point tests at another database)"""
+    global db
+    db = database
+
+def _now_iso() -> str:
+    """Current UTC time as the ISO-8601 "...Z" string stored on documents"""
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+# Display names of inviters, used for invitation notifications
+_inviter_name_cache = TTLCache(maxsize=10_000, ttl=300)
+
+async def get_inviter_name(user_id: str) -> str:
+    """Get a user's display name for notifications, cached per user"""
+    name = _inviter_name_cache.get(user_id)
+    if name is None:
+        inviter = await db.users.find_one({"id": user_id}, {"name": 1, "username": 1})
+        name = inviter.get("name", inviter.get("username", "Unknown")) if inviter else "Unknown"
+        _inviter_name_cache.set(user_id, name)
+    return name
+
+def invalidate_inviter_name(user_id: str):
+    """Drop a cached display name (call when the user's profile changes)"""
+    _inviter_name_cache.pop(user_id)
+
+# Short-lived read caches for threads polled by many clients. Writes made here
+# invalidate them; writes from elsewhere (WS server, username sync) show up
+# once the TTL lapses.
+READ_CACHE_TTL = 2
+# thread_id -> thread document (without the computed is_online flags)
+_thread_cache = TTLCache(maxsize=2048, ttl=READ_CACHE_TTL)
+# thread_id -> {(limit, order, include_snapshot): encoded response body}
+_messages_cache = TTLCache(maxsize=256, ttl=READ_CACHE_TTL)
+
+def invalidate_thread_cache(thread_id: str):
+    """Drop cached reads of a thread and its messages (call after writing to either)"""
+    _thread_cache.pop(thread_id)
+    _messages_cache.pop(thread_id)
 
 async def create_thread_handler(request: Request, thread_data: Dict[str, Any] = Body(...)):
     verify_token(thread_data.get("token", ""))
-    try:
-        db = get_db()
-        thread_id = str(ObjectId())
-        now = datetime.utcnow().isoformat() + "Z"
-        users = thread_data.get("users", [])
-        name = thread_data.get("name")
-
-        # Ensure users array items have required fields (id, username, name, joined_at)
-        # Fetch username from users collection if not provided
-        normalized_users: List[Dict[str, Any]] = []
-        for u in users:
-            if not isinstance(u, dict):
-                continue
-            user_id = u.get("id")
-            user_name = u.get("name")
-            username = u.get("username")
-            joined_at = u.get("joined_at") or now
-            
-            # Fetch username from users collection if not provided
-            if not username and user_id:
-                user_doc = db.users.find_one({"id": user_id}, {"username": 1, "name": 1})
-                if user_doc:
-                    username = user_doc.get("username", "")
-                    if not user_name:
-                        user_name = user_doc.get("name", "")
-            
-            # Allow empty username, but require fields to be present
-            if user_id is None or user_name is None:
-                continue
-            if not user_id:  # user_id cannot be empty
-                continue
-            
-            normalized_users.append({
-                "id": user_id,
-                "username": username or user_name,  # Fallback to name if username empty
-                "name": user_name,
-                "joined_at": joined_at
-            })
-
-        invites = thread_data.get("invites", [])
-
-        thread_doc = {
-            "schema_version": 1,
-            "id": thread_id,
-            "name": name,
-            "users": normalized_users,
-            "messages": [],
-            "invites": invites,
-            "created_at": now,
-            "updated_at": now
-        }
+    thread_id = str(ObjectId())
+    now = _now_iso()
+    users = thread_data.get("users", [])
+    name = thread_data.get("name")
 
-        db.threads.insert_one(thread_doc)
-        
-        # Update each user's threads array
-        for user in normalized_users:
-            user_id = user.get("id")
-            if user_id:
-                db.users.update_one(
-                    {"id": user_id},
-                    {"$addToSet": {"threads": thread_id}}  # $addToSet prevents duplicates
-                )
+    # Ensure users array items have required fields (id, username, name, joined_at)
+    # Fetch usernames from users collection if not provided, in one query
+    lookup_ids = [u["id"] for u in users if isinstance(u, dict) and u.get("id") and not u.get("username")]
+    user_docs = {}
+    if lookup_ids:
+        cursor = db.users.find({"id": {"$in": lookup_ids}}, {"_id": 0, "id": 1, "username": 1, "name": 1})
+        user_docs = {d["id"]: d async for d in cursor}
+    
+    normalized_users: List[Dict[str, Any]] = []
+    for u in users:
+        if not isinstance(u, dict):
+            continue
+        user_id = u.get("id")
+        user_name = u.get("name")
+        username = u.get("username")
+        joined_at = u.get("joined_at") or now
+        
+        # Fill in username from users collection if not provided
+        if not username and user_id:
+            user_doc = user_docs.get(user_id)
+            if user_doc:
+                username = user_doc.get("username", "")
+                if not user_name:
+                    user_name = user_doc.get("name", "")
+        
+        # Allow empty username, but require fields to be present
+        if user_id is None or user_name is None:
+            continue
+        if not user_id:  # user_id cannot be empty
+            continue
         
-        return {"thread_id": thread_id, "status": "created"}
-    except Exception as e:
-        if isinstance(e, HTTPException): raise e
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        normalized_users.append({
+            "id": user_id,
+            "username": username or user_name,  # Fallback to name if username empty
+            "name": user_name,
+            "joined_at": joined_at
+        })
+
+    invites = thread_data.get("invites", [])
+
+    thread_doc = {
+        "schema_version": 1,
+        "id": thread_id,
+        "name": name,
+        "users": normalized_users,
+        "messages": [],
+        "recent_messages": [],
+        "invites": invites,
+        "created_at": now,
+        "updated_at": now
+    }
+
+    await db.threads.insert_one(thread_doc)
+    
+    # Update every member's threads array in one round-trip
+    member_ids = [user["id"] for user in normalized_users]
+    if member_ids:
+        await db.users.update_many(
+            {"id": {"$in": member_ids}},
+            {"$addToSet": {"threads": thread_id}}  # $addToSet prevents duplicates
+        )
+    
+    return {"thread_id": thread_id, "status": "created"}
 
 async def add_checkpoint_handler(request: Request, thread_id: str, checkpoint_data: Dict[str, Any] = Body(...)):
     verify_token(checkpoint_data.get("token", ""))
@@ -101,139 +154,122 @@ async def add_checkpoint_handler(request: Request, thread_id: str, checkpoint_da
 
 async def join_thread_handler(request: Request, thread_id: str, user_data: Dict[str, Any] = Body(...)):
     verify_token(user_data.get("token", ""))
-    try:
-        db = get_db()
-        thread = db.threads.find_one({"id": thread_id})
-        if not thread:
-            raise HTTPException(status_code=404, detail=f"Thread not found: {thread_id}")
-        
-        user_id = user_data.get("user_id")
-        user_name = user_data.get("user_name")
-        # Allow empty username (anonymous users), but require the fields to be present
-        if user_id is None or user_name is None:
-            raise HTTPException(status_code=400, detail="user_id and user_name are required")
-        if not user_id:
-            raise HTTPException(status_code=400, detail="user_id cannot be empty")
-        
-        # Fetch username from users collection
-        user_doc = db.users.find_one({"id": user_id}, {"username": 1, "name": 1})
-        username = user_doc.get("username", user_name) if user_doc else user_name
-        display_name = user_doc.get("name", user_name) if user_doc else user_name
-        
-        existing_users = [u["id"] for u in thread.get("users", [])]
-        if user_id in existing_users:
-            return {"status": "already_member"}
-        
-        # Handle username collision by adding number suffix if needed
-        existing_usernames = [u.get("username", u.get("name")) for u in thread.get("users", [])]
-        final_username = username
-        
-        if username in existing_usernames:
-            # Username collision detected, find a unique suffix
-            counter = 1
-            while f"{username}_{counter}" in existing_usernames:
-                counter += 1
+    now = _now_iso()
+    user_id = user_data.get("user_id")
+    user_name = user_data.get("user_name")
+    # Allow empty username (anonymous users), but require the fields to be present
+    if user_id is None or user_name is None:
+        raise HTTPException(status_code=400, detail="user_id and user_name are required")
+    if not user_id:
+        raise HTTPException(status_code=400, detail="user_id cannot be empty")
+    
+    # Fetch the members (ids and names only, for the collision check) and the
+    # user's profile concurrently
+    thread, user_doc = await asyncio.gather(
+        db.threads.find_one({"id": thread_id}, {"_id": 0, "users.id": 1, "users.username": 1, "users.name": 1}),
+        db.users.find_one({"id": user_id}, {"username": 1, "name": 1}),
+    )
+    if not thread:
+        raise HTTPException(status_code=404, detail=f"Thread not found: {thread_id}")
+    
+    username = user_doc.get("username", user_name) if user_doc else user_name
+    display_name = user_doc.get("name", user_name) if user_doc else user_name
+    
+    members = thread.get("users", [])
+    if any(u["id"] == user_id for u in members):
+        return {"status": "already_member"}
+    
+    # Handle username collision by adding number suffix if needed
+    existing_usernames = {u.get("username", u.get("name")) for u in members}
+    final_username = username
+    
+    if username in existing_usernames:
+        # Username collision detected, find a unique suffix
+        for counter in itertools.count(1):
             final_username = f"{username}_{counter}"
-            print(f"Username collision detected. Changed '{username}' to '{final_username}'")
-        
-        new_user = {
-            "id": user_id,
-            "username": final_username,
-            "name": display_name,
-            "joined_at": datetime.utcnow().isoformat() + "Z"
-        }
-        db.threads.update_one(
-            {"id": thread_id},
-            {
-                "$push": {"users": new_user},
-                "$set": {"updated_at": datetime.utcnow().isoformat() + "Z"}
-            }
-        )
-        
-        # Update the user's threads array
-        db.users.update_one(
-            {"id": user_id},
-            {"$addToSet": {"threads": thread_id}}  # $addToSet prevents duplicates
-        )
-        
-        # Also update the user's username in the users collection if it was modified
-        if final_username != username:
-            db.users.update_one(
-                {"id": user_id},
-                {"$set": {
-                    "username": final_username
-                }}
-            )
-        
-        # Notify existing thread members that user joined (via WebSocket)
-        try:
-            from ws.router import send_invitation_accepted_notification
-            asyncio.create_task(send_invitation_accepted_notification(
-                thread_id, 
-                user_id, 
-                final_username,
-                None  # No specific inviter for direct join
-            ))
-        except Exception as e:
-            logger.error(f"Failed to send join notification: {e}")
-        
-        return {
-            "status": "user_added",
-            "username": final_username  # Return the final username (possibly modified)
-        }
-    except Exception as e:
-        if isinstance(e, HTTPException): raise e
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
-
-async def get_threads_handler(request: Request, token: str, limit: int = 50, offset: int = 0, user_id: Optional[str] = None):
-    verify_token(token)
+            if final_username not in existing_usernames:
+                break
+        print(f"Username collision detected. Changed '{username}' to '{final_username}'")
+    
+    new_user = {
+        "id": user_id,
+        "username": final_username,
+        "name": display_name,
+        "joined_at": now
+    }
+    # Membership is re-checked by the filter, so a concurrent join of the same
+    # user can't push them twice
+    joined = await db.threads.find_one_and_update(
+        {"id": thread_id, "users.id": {"$ne": user_id}},
+        {
+            "$push": {"users": new_user},
+            "$set": {"updated_at": now}
+        },
+        projection={"_id": 1}
+    )
+    if joined is None:
+        return {"status": "already_member"}
+    invalidate_thread_cache(thread_id)
+    
+    # Update the user's threads array, and the user's username in the users
+    # collection if it was modified
+    user_update = {"$addToSet": {"threads": thread_id}}  # $addToSet prevents duplicates
+    if final_username != username:
+        user_update["$set"] = {"username": final_username}
+    await db.users.update_one({"id": user_id}, user_update)
+    
+    # Notify existing thread members that user joined (via WebSocket)
     try:
-        db = get_db()
-        # Fix: Only add user_id filter if it's actually provided and not None
-        query = {}
-        if user_id is not None and user_id.strip():
-            query["users.id"] = user_id
-            
-        total = db.threads.count_documents(query)
-        threads_cursor = db.threads.find(query, {"_id": 0}).sort("updated_at", -1).limit(limit).skip(offset)
-        threads = list(threads_cursor)
-        
-        # Compute is_online from WebSocket connections (memory)
-        from ws.router import clients
-        logger.info(f"🔍 Computing is_online for threads. Active WebSocket clients: {list(clients.keys())}")
-        for thread in threads:
-            users = thread.get("users", [])
-            for user in users:
-                if isinstance(user, dict) and user.get("id"):
-                    # Check if user is connected via WebSocket
-                    user_id = user["id"]
-                    is_online = user_id in clients
-                    user["is_online"] = is_online
-                    logger.debug(f"   User {user_id} ({user.get('username', 'unknown')}): is_online={is_online}")
-        
-        return {
-            "threads": threads,
-            "pagination": {
-                "limit": limit,
-                "offset": offset,
-                "total": total,
-                "has_more": (offset + limit) < total
-            }
-        }
+        enqueue_invitation_accepted(
+            thread_id, 
+            user_id, 
+            final_username,
+            None  # No specific inviter for direct join
+        )
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        logger.error(f"Failed to send join notification: {e}")
+    
+    return {
+        "status": "user_added",
+        "username": final_username  # Return the final username (possibly modified)
+    }
 
-async def get_thread_handler(request: Request, thread_id: str, token: str = Query(...)):
+async def get_threads_handler(request: Request, token: str, limit: int = 50, offset: int = 0, user_id: Optional[str] = None, cursor: Optional[str] = None):
     verify_token(token)
-    try:
-        db = get_db()
-        thread = db.threads.find_one({"id": thread_id}, {"_id": 0})
-        if not thread:
-            raise HTTPException(status_code=404, detail=f"Thread not found: {thread_id}")
-        
-        # Compute is_online from WebSocket connections (memory)
-        from ws.router import clients
-        logger.info(f"🔍 Computing is_online for thread {thread_id}. Active WebSocket clients: {list(clients.keys())}")
+    # Fix: Only add user_id filter if it's actually provided and not None
+    query = {}
+    if user_id is not None and user_id.strip():
+        query["users.id"] = user_id
+    
+    # Page and total run concurrently. The page is sorted on (updated_at, id),
+    # served by the (users.id, updated_at, id) index; `cursor` (the last
+    # seen "updated_at|id") turns deep pages into an index range instead of
+    # a skip, and the id tiebreak keeps threads sharing an updated_at from
+    # being skipped across a page boundary.
+    page_query = query
+    if cursor:
+        cursor_updated_at, _, cursor_id = cursor.partition("|")
+        after = [{"updated_at": {"$lt": cursor_updated_at}}]
+        if cursor_id:
+            after.append({"updated_at": cursor_updated_at, "id": {"$lt": cursor_id}})
+        page_query = {**query, "$or": after}
+    # One extra document tells whether another page exists
+    page = db.threads.find(page_query, {"_id": 0, "recent_messages": 0}).sort(
+        [("updated_at", -1), ("id", -1)]
+    )
+    if offset and not cursor:
+        page = page.skip(offset)
+    page, total = await asyncio.gather(
+        page.limit(limit + 1).to_list(length=limit + 1),
+        db.threads.count_documents(query),
+    )
+    threads = page[:limit]
+    has_more = len(page) > limit
+    
+    # Compute is_online from WebSocket connections (memory)
+    from ws.router import clients
+    logger.info(f"🔍 Computing is_online for threads. Active WebSocket clients: {list(clients.keys())}")
+    for thread in threads:
         users = thread.get("users", [])
         for user in users:
             if isinstance(user, dict) and user.get("id"):
@@ -241,413 +277,506 @@ async def get_thread_handler(request: Request, thread_id: str, token: str = Quer
                 user_id = user["id"]
                 is_online = user_id in clients
                 user["is_online"] = is_online
-                logger.info(f"   User {user_id} ({user.get('username', 'unknown')}): is_online={is_online}")
-        
-        return thread
-    except Exception as e:
-        if isinstance(e, HTTPException): raise e
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+                logger.debug(f"   User {user_id} ({user.get('username', 'unknown')}): is_online={is_online}")
+    
+    # The find projection drops _id, so the documents are already JSON-safe; skip jsonable_encoder
+    return JSONResponse(content={
+        "threads": threads,
+        "pagination": {
+            "limit": limit,
+            "offset": offset,
+            "total": total,
+            "has_more": has_more,
+            "next_cursor": f"{threads[-1].get('updated_at')}|{threads[-1].get('id')}" if has_more else None
+        }
+    })
+
+async def get_thread_handler(request: Request, thread_id: str, token: str = Query(...)):
+    verify_token(token)
+    cached = _thread_cache.get(thread_id)
+    if cached is None:
+        cached = await db.threads.find_one(
+            {"id": thread_id},
+            {"_id": 0, "recent_messages": {"$slice": -RECENT_MESSAGES_RETURNED}}
+        )
+        if not cached:
+            raise HTTPException(status_code=404, detail=f"Thread not found: {thread_id}")
+        _thread_cache.set(thread_id, cached)
+    
+    # Compute is_online from WebSocket connections (memory), on copies so the
+    # cached document stays untouched
+    from ws.router import clients
+    logger.info(f"🔍 Computing is_online for thread {thread_id}. Active WebSocket clients: {list(clients.keys())}")
+    users = []
+    for user in cached.get("users", []):
+        if isinstance(user, dict) and user.get("id"):
+            # Check if user is connected via WebSocket
+            user_id = user["id"]
+            is_online = user_id in clients
+            user = {**user, "is_online": is_online}
+            logger.info(f"   User {user_id} ({user.get('username', 'unknown')}): is_online={is_online}")
+        users.append(user)
+    thread = {**cached, "users": users}
+    
+    # Documents are already JSON-safe (no _id), so skip jsonable_encoder
+    return JSONResponse(content=thread)
 
 async def update_thread_handler(request: Request, thread_id: str, update_data: Dict[str, Any] = Body(...)):
     verify_token(update_data.get("token", ""))
-    try:
-        db = get_db()
-        
-        # Check if thread exists first
-        thread = db.threads.find_one({"id": thread_id})
-        if not thread:
-            raise HTTPException(status_code=404, detail=f"Thread not found: {thread_id}")
-        
-        # Allow only schema fields: users, messages, invites
-        allowed_fields = {"users", "messages", "invites"}
-        provided_fields = set(update_data.keys()) - {"token"}
-        unsupported = provided_fields - allowed_fields
-        if unsupported:
-            raise HTTPException(status_code=400, detail=f"Unsupported fields: {', '.join(sorted(unsupported))}")
-
-        update_fields = {k: v for k, v in update_data.items() if k in allowed_fields}
-        update_fields["updated_at"] = datetime.utcnow().isoformat() + "Z"
-        
-        result = db.threads.update_one({"id": thread_id}, {"$set": update_fields})
+    # Allow only schema fields: users, messages, invites (one pass over the body)
+    update_fields = {}
+    unsupported = []
+    for key, value in update_data.items():
+        if key == "token":
+            continue
+        if key in THREAD_UPDATABLE_FIELDS:
+            update_fields[key] = value
+        else:
+            unsupported.append(key)
+    if unsupported:
+        raise HTTPException(status_code=400, detail=f"Unsupported fields: {', '.join(sorted(unsupported))}")
+    
+    update_fields["updated_at"] = _now_iso()
+    # A replaced messages list gets a matching recent_messages copy
+    if isinstance(update_fields.get("messages"), list):
+        recent_ids = [m for m in update_fields["messages"][-RECENT_MESSAGES_CAP:] if isinstance(m, str)]
+        found = await db.messages.find(
+            {"id": {"$in": recent_ids}}, {"_id": 0, "snapshot": 0}
+        ).to_list(length=None)
+        by_id = {message["id"]: message for message in found}
+        update_fields["recent_messages"] = [by_id[m] for m in recent_ids if m in by_id]
+    
+    # A missing thread shows up as no match
+    result = await db.threads.update_one({"id": thread_id}, {"$set": update_fields})
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail=f"Thread not found: {thread_id}")
+    invalidate_thread_cache(thread_id)
         
-        if result.matched_count == 0:
-            raise HTTPException(status_code=404, detail=f"Thread not found: {thread_id}")
-            
-        return {"status": "updated"}
+    return {"status": "updated"}
+
+async def _notify_invited_user(thread_id: str, user_id: str, invited_by: str):
+    """Send the real-time invitation notification (runs after the response)"""
+    try:
+        # Get the name of the person who invited (for the notification)
+        inviter_name = await get_inviter_name(invited_by)
+        
+        # Send real-time notification
+        await send_thread_invitation_notification(
+            target_user_id=user_id,
+            from_user_id=invited_by,
+            from_user_name=inviter_name,
+            thread_id=thread_id,
+            thread_title=f"Thread {thread_id[:6]}"
+        )
     except Exception as e:
-        if isinstance(e, HTTPException): raise e
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        # The invitation itself is already stored
+        logger.warning(f"⚠️  Failed to send WebSocket notification: {e}")
 
-async def send_invitation_handler(request: Request, thread_id: str, invitation_data: Dict[str, Any] = Body(...)):
+async def send_invitation_handler(request: Request, thread_id: str, background_tasks: BackgroundTasks, invitation_data: Dict[str, Any] = Body(...)):
     verify_token(invitation_data.get("token", ""))
-    try:
-        db = get_db()
-        
-        # Check if thread exists
-        thread = db.threads.find_one({"id": thread_id})
-        if not thread:
-            raise HTTPException(status_code=404, detail=f"Thread not found: {thread_id}")
-        
-        user_id = invitation_data.get("user_id")
-        user_name = invitation_data.get("user_name")
-        invited_by = invitation_data.get("invited_by")
-        
-        if not user_id or not user_name or not invited_by:
-            raise HTTPException(status_code=400, detail="user_id, user_name, and invited_by are required")
-        
-        # Check if user is already a member
-        existing_users = [u["id"] for u in thread.get("users", [])]
-        if user_id in existing_users:
-            raise HTTPException(status_code=400, detail="User is already a member of this thread")
-        
-        # Check if user already has a pending invitation
-        existing_invites = thread.get("invites", [])
-        for invite in existing_invites:
-            if invite.get("user_id") == user_id and invite.get("status") == "pending":
-                raise HTTPException(status_code=400, detail="User already has a pending invitation")
-        
-        # Create new invitation
-        invitation = {
-            "user_id": user_id,
-            "user_name": user_name,
-            "status": "pending",
-            "invited_by": invited_by,
-            "invited_at": datetime.utcnow().isoformat() + "Z"
+    now = _now_iso()
+    
+    user_id = invitation_data.get("user_id")
+    user_name = invitation_data.get("user_name")
+    invited_by = invitation_data.get("invited_by")
+    
+    if not user_id or not user_name or not invited_by:
+        raise HTTPException(status_code=400, detail="user_id, user_name, and invited_by are required")
+    
+    # Check the thread exists; the $elemMatch projections return only the
+    # invitee's membership entry and pending invite (if any), not the arrays
+    pending_invite = {"user_id": user_id, "status": "pending"}
+    thread = await db.threads.find_one(
+        {"id": thread_id},
+        {"_id": 0, "users": {"$elemMatch": {"id": user_id}}, "invites": {"$elemMatch": pending_invite}}
+    )
+    if not thread:
+        raise HTTPException(status_code=404, detail=f"Thread not found: {thread_id}")
+    
+    # Check if user is already a member
+    if thread.get("users"):
+        raise HTTPException(status_code=400, detail="User is already a member of this thread")
+    
+    # Check if user already has a pending invitation
+    if thread.get("invites"):
+        raise HTTPException(status_code=400, detail="User already has a pending invitation")
+    
+    # Create new invitation
+    invitation = {
+        "user_id": user_id,
+        "user_name": user_name,
+        "status": "pending",
+        "invited_by": invited_by,
+        "invited_at": now
+    }
+    
+    # Add the invitation to the thread
+    thread_result = await db.threads.update_one(
+        # Re-checked by the filter, so concurrent invites can't duplicate
+        {"id": thread_id, "users.id": {"$ne": user_id}, "invites": {"$not": {"$elemMatch": pending_invite}}},
+        {
+            "$push": {"invites": invitation},
+            "$set": {"updated_at": now}
         }
-        
-        # Initialize invites array if it doesn't exist, then add invitation
-        db.threads.update_one(
-            {"id": thread_id},
-            {
-                "$push": {"invites": invitation},
-                "$set": {"updated_at": datetime.utcnow().isoformat() + "Z"}
-            }
+    )
+    if thread_result.matched_count == 0:
+        raise HTTPException(status_code=400, detail="User is already a member or has a pending invitation")
+    invalidate_thread_cache(thread_id)
+    
+    # Only then record the pending invite on the invited user's document, so
+    # a rejected invite leaves nothing behind; a failed user update is not fatal
+    try:
+        await db.users.update_one(
+            {"id": user_id},
+            {"$addToSet": {"pending_invites_to_threads": thread_id}}
         )
-        
-        # Add pending invite to the invited user's document
-        try:
-            db.users.update_one(
-                {"id": user_id},
-                {"$addToSet": {"pending_invites_to_threads": thread_id}}
-            )
-        except Exception:
-            pass
-
-        # Send WebSocket notification to invited user
-        try:
-            # Get the name of the person who invited (for the notification)
-            inviter = db.users.find_one({"id": invited_by}, {"name": 1, "username": 1})
-            inviter_name = inviter.get("name", inviter.get("username", "Unknown")) if inviter else "Unknown"
-            
-            # Send real-time notification
-            await send_thread_invitation_notification(
-                target_user_id=user_id,
-                from_user_id=invited_by,
-                from_user_name=inviter_name,
-                thread_id=thread_id,
-                thread_title=f"Thread {thread_id[:6]}"
-            )
-        except Exception as e:
-            # Don't fail the request if WebSocket notification fails
-            print(f"⚠️  Failed to send WebSocket notification: {e}")
-        
-        return {"status": "invitation_sent"}
     except Exception as e:
-        if isinstance(e, HTTPException): raise e
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        logger.error(f"Failed to add pending invite for {user_id}: {e}")
+
+    # Send WebSocket notification to invited user once the response is out
+    background_tasks.add_task(_notify_invited_user, thread_id, user_id, invited_by)
+    
+    return {"status": "invitation_sent"}
 
 # Messages handlers (store messages in a separate collection with reference, or inline for simplicity)
+async def _stream_messages(first_batch: list, cursor):
+    """Encode an already fetched (non-empty) first batch, then the rest of the
+    cursor, as {"messages": [...]} one document at a time"""
+    yield b'{"messages":['
+    yield b','.join(json.dumps(doc, separators=(",", ":")).encode() for doc in first_batch)
+    async for doc in cursor:
+        yield b',' + json.dumps(doc, separators=(",", ":")).encode()
+    yield b']}'
+
 async def get_messages_handler(request: Request, thread_id: str, token: str, limit: int = 100, order: str = "asc", include_snapshot: bool = True):
     verify_token(token)
-    try:
-        db = get_db()
-        sort_dir = 1 if order == "asc" else -1
-        projection = {"_id": 0}
-        if not include_snapshot:
-            projection["snapshot"] = 0
-        cursor = (
-            db.messages
-            .find({"parent_thread": thread_id}, projection)
-            .sort("timestamp", sort_dir)
-            .limit(limit)
-        )
-        return {"messages": list(cursor)}
-    except Exception as e:
-        if isinstance(e, HTTPException): raise e
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    cache_key = (limit, order, include_snapshot)
+    cached_pages = _messages_cache.get(thread_id)
+    if cached_pages is not None and cache_key in cached_pages:
+        return Response(content=cached_pages[cache_key], media_type="application/json")
+    sort_dir = 1 if order == "asc" else -1
+    projection = {"_id": 0}
+    if not include_snapshot:
+        projection["snapshot"] = 0
+    # Served by the (parent_thread, timestamp) index; not hinted, so a
+    # missing index degrades to a slower plan instead of an error
+    cursor = (
+        db.messages
+        .find({"parent_thread": thread_id}, projection)
+        .sort("timestamp", sort_dir)
+        .limit(limit)
+    )
+    if limit > STREAM_MESSAGES_OVER:
+        # The status goes out before the body, so the first batch is read
+        # here: a query error still surfaces as an error response
+        first_batch = await cursor.to_list(length=STREAM_MESSAGES_OVER)
+        if len(first_batch) < STREAM_MESSAGES_OVER:
+            return JSONResponse(content={"messages": first_batch})
+        return StreamingResponse(_stream_messages(first_batch, cursor), media_type="application/json")
+    response = JSONResponse(content={"messages": await cursor.to_list(length=limit)})
+    if cached_pages is None:
+        cached_pages = {}
+        _messages_cache.set(thread_id, cached_pages)
+    cached_pages[cache_key] = response.body
+    return response
 
 async def get_message_by_id_handler(request: Request, message_id: str, token: str, include_snapshot: bool = True):
     verify_token(token)
-    try:
-        db = get_db()
-        projection = {"_id": 0}
-        if not include_snapshot:
-            projection["snapshot"] = 0
-        doc = db.messages.find_one({"id": message_id}, projection)
-        if not doc:
-            raise HTTPException(status_code=404, detail=f"Message not found: {message_id}")
-        return doc
-    except Exception as e:
-        if isinstance(e, HTTPException): raise e
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    projection = {"_id": 0}
+    if not include_snapshot:
+        projection["snapshot"] = 0
+    doc = await db.messages.find_one({"id": message_id}, projection)
+    if not doc:
+        raise HTTPException(status_code=404, detail=f"Message not found: {message_id}")
+    return JSONResponse(content=doc)
 
-async def create_message_handler(request: Request, message_data: Dict[str, Any] = Body(...)):
+async def create_message_handler(request: Request, message_data: Dict[str, Any] = Body(...), echo: str = "full"):
     verify_token(message_data.get("token", ""))
-    try:
-        db = get_db()
-        thread_id = message_data.get("parent_thread")
-        user_id = message_data.get("user_id")
-        snapshot = message_data.get("snapshot")
-        # Explicitly supported optional: snapshot_metadata, renders
-        snapshot_metadata = message_data.get("snapshot_metadata")
-        renders = message_data.get("renders", [])
-        timestamp = message_data.get("timestamp") or datetime.utcnow().isoformat() + "Z"
-        if not thread_id or not user_id or snapshot is None:
-            raise HTTPException(status_code=400, detail="parent_thread, user_id and snapshot are required")
-
-        # ensure thread exists
-        thread = db.threads.find_one({"id": thread_id})
-        if not thread:
-            raise HTTPException(status_code=404, detail=f"Thread not found: {thread_id}")
+    thread_id = message_data.get("parent_thread")
+    user_id = message_data.get("user_id")
+    snapshot = message_data.get("snapshot")
+    # Explicitly supported optional: snapshot_metadata, renders
+    snapshot_metadata = message_data.get("snapshot_metadata")
+    renders = message_data.get("renders", [])
+    created_at = _now_iso()
+    timestamp = message_data.get("timestamp") or created_at
+    if not thread_id or not user_id or snapshot is None:
+        raise HTTPException(status_code=400, detail="parent_thread, user_id and snapshot are required")
 
-        message_id = str(ObjectId())
-        created_at = datetime.utcnow().isoformat() + "Z"
-        doc = {
-            "id": message_id,
-            "created_at": created_at,
-            "timestamp": timestamp,
-            "user_id": user_id,
-            "parent_thread": thread_id,
-            "snapshot": snapshot,
-            **({"snapshot_metadata": snapshot_metadata} if snapshot_metadata is not None else {}),
-            "renders": renders,
-        }
-        # Insert a shallow copy so the original doc isn't mutated with Mongo's _id
-        db.messages.insert_one({**doc})
-        # update thread messages array and updated_at
-        db.threads.update_one({"id": thread_id}, {"$push": {"messages": message_id}, "$set": {"updated_at": created_at}})
-        # Broadcast realtime notification to thread members (fire-and-forget)
+    message_id = str(ObjectId())
+    doc = {
+        "id": message_id,
+        "created_at": created_at,
+        "timestamp": timestamp,
+        "user_id": user_id,
+        "parent_thread": thread_id,
+        "snapshot": snapshot,
+        "renders": renders,
+    }
+    if snapshot_metadata is not None:
+        doc["snapshot_metadata"] = snapshot_metadata
+    recent_message = {k: v for k, v in doc.items() if k != "snapshot"}
+    # Insert the message and push it onto the thread concurrently. The thread
+    # update doubles as the existence check; whichever write fails (or a
+    # missing thread) is compensated by a best-effort undo of the other. If the
+    # undo itself fails it is logged and an orphaned message or dangling
+    # thread reference may remain.
+    insert_result, thread_result = await asyncio.gather(
+        db.messages.insert_one(doc),
+        db.threads.update_one(
+            {"id": thread_id},
+            {
+                "$push": {
+                    "messages": message_id,
+                    "recent_messages": {"$each": [recent_message], "$slice": -RECENT_MESSAGES_CAP},
+                },
+                "$set": {"updated_at": created_at}
+            }
+        ),
+        return_exceptions=True,
+    )
+    # insert_one set Mongo's ObjectId _id on doc; drop it so the same dict can
+    # be broadcast and echoed without copying the snapshot
+    doc.pop("_id", None)
+    thread_missing = not isinstance(thread_result, Exception) and thread_result.matched_count == 0
+    if isinstance(thread_result, Exception) or thread_missing:
+        if not isinstance(insert_result, Exception):
+            try:
+                await db.messages.delete_one({"id": message_id})
+            except Exception:
+                logger.exception(f"❌ Failed to remove orphaned message {message_id}")
+        if thread_missing:
+            raise HTTPException(status_code=404, detail=f"Thread not found: {thread_id}")
+        raise thread_result
+    if isinstance(insert_result, Exception):
         try:
-            asyncio.create_task(send_message_created_notification(thread_id, {**doc}))
+            await db.threads.update_one(
+                {"id": thread_id},
+                {"$pull": {"messages": message_id, "recent_messages": {"id": message_id}}}
+            )
         except Exception:
-            pass
-        # Return the original doc (contains only strings), avoiding ObjectId in response
-        return doc
-    except Exception as e:
-        if isinstance(e, HTTPException): raise e
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+            logger.exception(f"❌ Failed to pull message {message_id} from thread {thread_id}")
+        raise insert_result
+    invalidate_thread_cache(thread_id)
+    # Broadcast realtime notification to thread members (fire-and-forget)
+    try:
+        enqueue_message_created(thread_id, doc)
+    except Exception:
+        pass
+    # The client already has the snapshot it just sent; echo=metadata skips it
+    if echo == "metadata":
+        return JSONResponse(content={k: v for k, v in doc.items() if k not in ("snapshot", "snapshot_metadata")})
+    return JSONResponse(content=doc)
 
-async def delete_message_handler(request: Request, message_id: str, token: str = Query(...)):
-    verify_token(token)
+def _delete_render_files(file_keys: List[str]):
+    """Remove a deleted message's render files from S3 (runs after the response)"""
     try:
-        from storage.s3_service import get_s3_service
-        import re
-        
-        db = get_db()
-        # Find message
-        message = db.messages.find_one({"id": message_id})
-        if not message:
-            raise HTTPException(status_code=404, detail=f"Message not found: {message_id}")
-        
-        thread_id = message.get("parent_thread")
-        
-        # Delete associated render files from S3
-        renders = message.get("renders", [])
-        if renders:
-            s3_service = get_s3_service()
-            for render in renders:
-                try:
-                    render_url = render.get("url", "")
-                    if render_url:
-                        # Extract file key from URL
-                        # URL format: https://fortuned.fra1.digitaloceanspaces.com/prod/renders/uuid.mp3
-                        # We need: prod/renders/uuid.mp3
-                        match = re.search(r'\.com/(.+)$', render_url)
-                        if match:
-                            file_key = match.group(1)
-                            deleted = s3_service.delete_file(file_key)
-                            if deleted:
-                                logger.info(f"🗑️  Deleted render from S3: {file_key}")
-                            else:
-                                logger.warning(f"⚠️  Failed to delete render from S3: {file_key}")
-                except Exception as e:
-                    # Don't fail message deletion if S3 deletion fails
-                    logger.error(f"❌ Error deleting render from S3: {e}")
-        
-        # Delete message document
-        db.messages.delete_one({"id": message_id})
-        
-        # Remove reference from thread and update timestamp
-        if thread_id:
-            db.threads.update_one({"id": thread_id}, {"$pull": {"messages": message_id}, "$set": {"updated_at": datetime.utcnow().isoformat() + "Z"}})
-        
-        return {"status": "deleted", "id": message_id, "renders_deleted": len(renders)}
+        deleted = get_s3_service().delete_files(file_keys)
+        logger.info(f"🗑️  Deleted {deleted}/{len(file_keys)} renders from S3")
     except Exception as e:
-        if isinstance(e, HTTPException): raise e
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        # Message deletion has already succeeded
+        logger.error(f"❌ Error deleting renders from S3: {e}")
+
+async def delete_message_handler(request: Request, message_id: str, background_tasks: BackgroundTasks, token: str = Query(...)):
+    verify_token(token)
+    now = _now_iso()
+    # Find message (only the fields needed for cleanup, not the snapshot)
+    message = await db.messages.find_one({"id": message_id}, {"_id": 0, "parent_thread": 1, "renders.url": 1})
+    if not message:
+        raise HTTPException(status_code=404, detail=f"Message not found: {message_id}")
+    
+    thread_id = message.get("parent_thread")
+    
+    # Delete associated render files from S3 in one batch, after responding
+    renders = message.get("renders", [])
+    file_keys = []
+    for render in renders:
+        match = S3_KEY_FROM_URL_RE.search(render.get("url") or "")
+        if match:
+            file_keys.append(match.group(1))
+    if file_keys:
+        background_tasks.add_task(_delete_render_files, file_keys)
+    
+    # Delete message document and, concurrently, remove the reference from
+    # the thread and update its timestamp
+    writes = [db.messages.delete_one({"id": message_id})]
+    if thread_id:
+        writes.append(db.threads.update_one(
+            {"id": thread_id},
+            {
+                "$pull": {"messages": message_id, "recent_messages": {"id": message_id}},
+                "$set": {"updated_at": now}
+            }
+        ))
+    await asyncio.gather(*writes)
+    if thread_id:
+        invalidate_thread_cache(thread_id)
+    
+    return {"status": "deleted", "id": message_id, "renders_deleted": len(renders)}
 
 async def attach_render_to_message_handler(request: Request, message_id: str, render_data: Dict[str, Any] = Body(...)):
     """Attach a render to an existing message (for background upload completion)"""
     verify_token(render_data.get("token", ""))
-    try:
-        db = get_db()
-        # Find message
-        message = db.messages.find_one({"id": message_id})
-        if not message:
-            raise HTTPException(status_code=404, detail=f"Message not found: {message_id}")
-        
-        # Get render from request
-        render = render_data.get("render")
-        if not render:
-            raise HTTPException(status_code=400, detail="render is required")
-        
-        # Add render to message
-        db.messages.update_one(
-            {"id": message_id},
-            {"$push": {"renders": render}}
-        )
-        
-        # Update thread timestamp
-        thread_id = message.get("parent_thread")
-        if thread_id:
+    # Find message (only its thread is needed, not the snapshot)
+    message = await db.messages.find_one({"id": message_id}, {"_id": 0, "parent_thread": 1})
+    if not message:
+        raise HTTPException(status_code=404, detail=f"Message not found: {message_id}")
+    
+    # Get render from request
+    render = render_data.get("render")
+    if not render:
+        raise HTTPException(status_code=400, detail="render is required")
+    
+    # Add render to message
+    await db.messages.update_one(
+        {"id": message_id},
+        {"$push": {"renders": render}}
+    )
+    
+    # Update thread timestamp and the thread's recent copy of the message
+    thread_id = message.get("parent_thread")
+    if thread_id:
+        # The timestamp is always set; the recent copy is only updated when
+        # the thread holds one (older threads may have no recent_messages,
+        # and the message may have been evicted by the cap)
+        await asyncio.gather(
+            db.threads.update_one({"id": thread_id}, {"$set": {"updated_at": _now_iso()}}),
             db.threads.update_one(
-                {"id": thread_id},
-                {"$set": {"updated_at": datetime.utcnow().isoformat() + "Z"}}
-            )
-        
-        return {"status": "render_attached", "message_id": message_id}
-    except Exception as e:
-        if isinstance(e, HTTPException): raise e
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+                {"id": thread_id, "recent_messages.id": message_id},
+                {"$push": {"recent_messages.$.renders": render}}
+            ),
+        )
+        invalidate_thread_cache(thread_id)
+    
+    return {"status": "render_attached", "message_id": message_id}
 
 async def manage_invitation_handler(request: Request, thread_id: str, user_id: str, action_data: Dict[str, Any] = Body(...)):
     verify_token(action_data.get("token", ""))
-    try:
-        db = get_db()
-        
-        # Check if thread exists
-        thread = db.threads.find_one({"id": thread_id})
-        if not thread:
+    now = _now_iso()
+    
+    action = action_data.get("action")
+    if action not in ["accept", "decline"]:
+        raise HTTPException(status_code=400, detail="Action must be 'accept' or 'decline'")
+    
+    # Updates only apply while a pending invitation exists, so Mongo decides
+    # atomically whether there was one (matched_count)
+    pending_filter = {"id": thread_id, "invites": {"$elemMatch": {"user_id": user_id, "status": "pending"}}}
+    
+    async def raise_not_found():
+        if not await db.threads.find_one({"id": thread_id}, {"_id": 1}):
             raise HTTPException(status_code=404, detail=f"Thread not found: {thread_id}")
+        raise HTTPException(status_code=404, detail="No pending invitation found for this user")
+    
+    if action == "accept":
+        # The invitation (for the display name and inviter) and the user's
+        # current username are independent reads; the positional projection
+        # returns just the pending invite rather than the whole invites array
+        thread, user_doc = await asyncio.gather(
+            db.threads.find_one(pending_filter, {"_id": 0, "invites.$": 1}),
+            db.users.find_one({"id": user_id}, {"username": 1}),
+        )
+        if not thread:
+            await raise_not_found()
+        invitation = thread["invites"][0]
         
-        action = action_data.get("action")
-        if action not in ["accept", "decline"]:
-            raise HTTPException(status_code=400, detail="Action must be 'accept' or 'decline'")
-        
-        # Find the invitation
-        invites = thread.get("invites", [])
-        invitation = None
-        invite_index = None
-        
-        for i, invite in enumerate(invites):
-            if invite.get("user_id") == user_id and invite.get("status") == "pending":
-                invitation = invite
-                invite_index = i
-                break
+        # Add user to thread members
+        username = user_doc.get("username", invitation["user_name"]) if user_doc else invitation["user_name"]
         
-        if not invitation:
-            raise HTTPException(status_code=404, detail="No pending invitation found for this user")
+        new_user = {
+            "id": user_id,
+            "username": username,
+            "name": invitation["user_name"],
+            "joined_at": now
+        }
         
-        if action == "accept":
-            # Add user to thread members
-            # Get user's current username
-            user_doc = db.users.find_one({"id": user_id}, {"username": 1})
-            username = user_doc.get("username", invitation["user_name"]) if user_doc else invitation["user_name"]
-            
-            new_user = {
-                "id": user_id,
-                "username": username,
-                "name": invitation["user_name"],
-                "joined_at": datetime.utcnow().isoformat() + "Z"
+        # Remove invitation and add user in one atomic operation
+        result = await db.threads.update_one(
+            pending_filter,
+            {
+                "$push": {"users": new_user},
+                "$pull": {"invites": {"user_id": user_id}},
+                "$set": {"updated_at": now}
             }
-            
-            # Remove invitation and add user in one atomic operation
-            db.threads.update_one(
-                {"id": thread_id},
+        )
+        if result.matched_count == 0:
+            # Accepted or declined concurrently since the read
+            await raise_not_found()
+        invalidate_thread_cache(thread_id)
+        # Update user doc: remove pending invite and add thread to user's threads
+        try:
+            await db.users.update_one(
+                {"id": user_id},
                 {
-                    "$push": {"users": new_user},
-                    "$pull": {"invites": {"user_id": user_id}},
-                    "$set": {"updated_at": datetime.utcnow().isoformat() + "Z"}
+                    "$pull": {"pending_invites_to_threads": thread_id},
+                    "$addToSet": {"threads": thread_id}
                 }
             )
-            # Update user doc: remove pending invite and add thread to user's threads
-            try:
-                db.users.update_one(
-                    {"id": user_id},
-                    {
-                        "$pull": {"pending_invites_to_threads": thread_id},
-                        "$addToSet": {"threads": thread_id}
-                    }
-                )
-            except Exception:
-                pass
-            # Notify inviter and members
-            try:
-                invited_by = invitation.get("invited_by")
-                asyncio.create_task(send_invitation_accepted_notification(thread_id, user_id, invitation["user_name"], invited_by))
-            except Exception:
-                pass
-            return {"status": "invitation_accepted", "user_added": True}
-        
-        elif action == "decline":
-            # Remove invitation
+        except Exception:
+            pass
+        # Notify inviter and members
+        try:
+            invited_by = invitation.get("invited_by")
+            enqueue_invitation_accepted(thread_id, user_id, invitation["user_name"], invited_by)
+        except Exception:
+            pass
+        return {"status": "invitation_accepted", "user_added": True}
+    
+    elif action == "decline":
+        # Remove invitation and, concurrently, the pending invite from user doc
+        # (a failed user update is not fatal); no read of the thread needed
+        thread_result, _ = await asyncio.gather(
             db.threads.update_one(
-                {"id": thread_id},
+                pending_filter,
                 {
                     "$pull": {"invites": {"user_id": user_id}},
-                    "$set": {"updated_at": datetime.utcnow().isoformat() + "Z"}
+                    "$set": {"updated_at": now}
                 }
-            )
-            # Remove pending invite from user doc
-            try:
-                db.users.update_one(
-                    {"id": user_id},
-                    {"$pull": {"pending_invites_to_threads": thread_id}}
-                )
-            except Exception:
-                pass
-            return {"status": "invitation_declined"}
-    
-    except Exception as e:
-        if isinstance(e, HTTPException): raise e
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+            ),
+            db.users.update_one(
+                {"id": user_id},
+                {"$pull": {"pending_invites_to_threads": thread_id}}
+            ),
+            return_exceptions=True,
+        )
+        if isinstance(thread_result, Exception):
+            raise thread_result
+        if thread_result.matched_count == 0:
+            await raise_not_found()
+        invalidate_thread_cache(thread_id)
+        return {"status": "invitation_declined"}
+
 
 
 async def delete_thread_handler(request: Request, thread_id: str, token: str = Query(...)):
     """Delete a thread by ID"""
     verify_token(token)
-    try:
-        db = get_db()
-        
-        # Check if thread exists
-        thread = db.threads.find_one({"id": thread_id})
-        if not thread:
-            raise HTTPException(status_code=404, detail="Thread not found")
-        
-        # Get all users in the thread before deleting
-        thread_users = [u.get("id") for u in thread.get("users", [])]
-        
-        # Delete all messages associated with this thread
-        db.messages.delete_many({"parent_thread": thread_id})
-        
-        # Delete the thread itself
-        result = db.threads.delete_one({"id": thread_id})
-        
-        if result.deleted_count == 0:
-            raise HTTPException(status_code=404, detail="Thread not found")
-        
-        # Remove thread from all users' threads arrays
-        for user_id in thread_users:
-            if user_id:
-                db.users.update_one(
-                    {"id": user_id},
-                    {"$pull": {"threads": thread_id}}
-                )
-        
-        return {"status": "thread_deleted", "thread_id": thread_id}
+    # Check if thread exists
+    thread = await db.threads.find_one({"id": thread_id}, {"_id": 0, "users.id": 1})
+    if not thread:
+        raise HTTPException(status_code=404, detail="Thread not found")
     
-    except Exception as e:
-        if isinstance(e, HTTPException): raise e
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    # Get all users in the thread before deleting
+    thread_users = [u["id"] for u in thread.get("users", []) if u.get("id")]
+    
+    # Delete the thread's messages and the thread itself concurrently; the
+    # deployment runs a standalone mongod, so there's no transaction to wrap them in
+    _, result = await asyncio.gather(
+        db.messages.delete_many({"parent_thread": thread_id}),
+        db.threads.delete_one({"id": thread_id}),
+    )
+    
+    invalidate_thread_cache(thread_id)
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    
+    # Remove thread from all users' threads arrays
+    if thread_users:
+        await db.users.update_many(
+            {"id": {"$in": thread_users}},
+            {"$pull": {"threads": thread_id}}
+        )
+    
+    return {"status": "thread_deleted", "thread_id": thread_id}
+
 
 
@@ -1,25 +1,58 @@
-import uuid
+import re
+import json
 import bcrypt
-import hashlib
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from fastapi import Request, Query, HTTPException
-from fastapi.responses import JSONResponse
-from fastapi.encoders import jsonable_encoder
+from fastapi import Request, Query, HTTPException, BackgroundTasks
+from fastapi.responses import JSONResponse, StreamingResponse
 from typing import Optional, Dict, Any, List
 import os
-from pymongo import MongoClient
+import time
 from pydantic import BaseModel, Field
-from db.connection import get_database
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from db.connection import get_async_database
+from db.init_collections import USERNAME_SEARCH_COLLATION
+from http_api.auth import verify_token
 from bson import ObjectId
 
 # Initialize logger
 logger = logging.getLogger(__name__)
 
-# Initialize database connection
-db = get_database()
+# Initialize database connection (bound at startup by init_db)
+db = None
 
-API_TOKEN = os.getenv("API_TOKEN")
+def init_db():
+    """Bind the module's database handle to this process's async client"""
+    set_db(get_async_database())
+
+def set_db(database):
+    """Rebind the module's database handle (e.g. to point tests at another database)"""
+    global db
+    db = database
+
+# User list pages larger than this are streamed doc-by-doc instead of materialized
+STREAM_USERS_OVER = 500
+
+# Allowed username characters (length is checked separately for its own error)
+_USERNAME_RE = re.compile(r'^[A-Za-z0-9_-]+\Z')
+
+# (epoch second, ISO string) of the last timestamp handed out
+_ts_cache = (0, "")
+
+def _now_iso() -> str:
+    """Current UTC time as an ISO-8601 string, second resolution.
+
+    The string is rebuilt at most once per second; every other call is an
+    int compare against the cached second.
+    """
+    global _ts_cache
+    now = int(time.time())
+    if _ts_cache[0] != now:
+        _ts_cache = (now, datetime.fromtimestamp(now, timezone.utc).isoformat())
+    return _ts_cache[1]
 
 # Pydantic models for request/response
 class UserProfileInfo(BaseModel):
@@ -82,36 +115,52 @@ class FollowRequest(BaseModel):
     user_id: str
     target_user_id: str
 
-def get_db():
-    return get_database()
+# bcrypt work factor for new hashes; existing hashes are upgraded/downgraded
+# to it on the next successful login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
 
-def verify_token(token: str):
-    if token != API_TOKEN:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+# bcrypt is CPU-bound (and releases the GIL), so hashing runs on its own
+# pool instead of stalling the event loop
+_HASH_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="bcrypt")
 
 # Authentication functions
-def hash_password(password: str) -> tuple[str, str]:
-    """Hash password with bcrypt and return hash and salt"""
-    salt = bcrypt.gensalt()
+def _hash_password_sync(password: str) -> tuple[str, str]:
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     password_hash = bcrypt.hashpw(password.encode('utf-8'), salt)
     return password_hash.decode('utf-8'), salt.decode('utf-8')
 
-def verify_password(password: str, hashed: str) -> bool:
+async def hash_password(password: str) -> tuple[str, str]:
+    """Hash password with bcrypt and return hash and salt"""
+    return await asyncio.get_running_loop().run_in_executor(_HASH_POOL, _hash_password_sync, password)
+
+async def verify_password(password: str, hashed: str) -> bool:
     """Verify password against hash"""
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    return await asyncio.get_running_loop().run_in_executor(
+        _HASH_POOL, bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8')
+    )
+
+def password_needs_rehash(hashed: str) -> bool:
+    """Whether a stored hash ($2b$<cost>$...) was made with a different work factor"""
+    try:
+        return int(hashed.split('$')[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
 
 # API Endpoints
 async def login_handler(request: Request, login_data: LoginRequest):
     """Authenticate user with email and password"""
     try:
         # Find user by email
-        user = db.users.find_one({"email": login_data.email}, {"_id": 0})
+        user = await db.users.find_one(
+            {"email": login_data.email},
+            {"_id": 0, "id": 1, "username": 1, "name": 1, "email": 1, "password_hash": 1, "is_active": 1}
+        )
         
         if not user:
             raise HTTPException(status_code=401, detail="Invalid email or password")
         
         # Verify password
-        if not verify_password(login_data.password, user['password_hash']):
+        if not await verify_password(login_data.password, user['password_hash']):
             raise HTTPException(status_code=401, detail="Invalid email or password")
         
         # Check if user is active
@@ -120,11 +169,12 @@ async def login_handler(request: Request, login_data: LoginRequest):
         
         # IDs are now seeded as Mongo 24-hex in init; no migration at login
 
-        # Update last login
-        db.users.update_one(
-            {"id": user['id']},
-            {"$set": {"last_login": datetime.now(timezone.utc).isoformat()}}
-        )
+        # Stamp last_login only for a verified, active login; re-hash the
+        # password in the same write if the work factor changed
+        update = {"last_login": _now_iso()}
+        if password_needs_rehash(user['password_hash']):
+            update["password_hash"], update["salt"] = await hash_password(login_data.password)
+        await db.users.update_one({"id": user['id']}, {"$set": update})
         
         return LoginResponse(
             success=True,
@@ -143,21 +193,18 @@ async def login_handler(request: Request, login_data: LoginRequest):
 async def register_handler(request: Request, register_data: RegisterRequest):
     """Register new user"""
     try:
-        # Check if email already exists
-        existing_email = db.users.find_one({"email": register_data.email})
-        if existing_email:
-            raise HTTPException(status_code=400, detail="Email already registered")
-        
-        # Check if username already exists
-        existing_username = db.users.find_one({"username": register_data.username})
+        # Usernames aren't uniquely indexed, so they still need a probe; it
+        # overlaps with hashing. Email uniqueness is left to the index (below).
+        existing_username, (password_hash, salt) = await asyncio.gather(
+            db.users.find_one({"username": register_data.username}, {"_id": 1}),
+            hash_password(register_data.password),
+        )
         if existing_username:
             raise HTTPException(status_code=400, detail="Username already taken")
         
-        # Hash password
-        password_hash, salt = hash_password(register_data.password)
-        
         # Create new user (Mongo-style 24-hex ID)
         user_id = str(ObjectId())
+        timestamp = _now_iso()
         new_user = {
             "id": user_id,
             "username": register_data.username,
@@ -169,9 +216,9 @@ async def register_handler(request: Request, register_data: RegisterRequest):
                 "bio": "",
                 "location": ""
             },
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "last_login": datetime.now(timezone.utc).isoformat(),
-            "last_online": datetime.now(timezone.utc).isoformat(),
+            "created_at": timestamp,
+            "last_login": timestamp,
+            "last_online": timestamp,
             "is_active": True,
             "email_verified": False,
             "stats": {
@@ -183,8 +230,14 @@ async def register_handler(request: Request, register_data: RegisterRequest):
             "following": []
         }
         
-        # Insert user
-        db.users.insert_one(new_user)
+        # Insert user; the unique email index rejects duplicates atomically
+        try:
+            await db.users.insert_one(new_user)
+        except DuplicateKeyError as e:
+            key_pattern = (e.details or {}).get("keyPattern", {})
+            if "email" in key_pattern:
+                raise HTTPException(status_code=400, detail="Email already registered")
+            raise
         
         return LoginResponse(
             success=True,
@@ -203,15 +256,16 @@ async def register_handler(request: Request, register_data: RegisterRequest):
 async def session_handler(request: Request, user_data: UserSessionRequest):
     """Get or create a user session for anonymous, device-based authentication."""
     try:
-        # Find user by ID (exclude MongoDB's _id field)
-        existing_user = db.users.find_one({"id": user_data.id}, {"_id": 0})
+        # Find user by ID (exclude MongoDB's _id field), updating last_online
+        # in the same round-trip; the pre-update document is returned
+        existing_user = await db.users.find_one_and_update(
+            {"id": user_data.id},
+            {"$set": {"last_online": _now_iso()}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
         
         if existing_user:
-            # User exists, update last_online and return
-            db.users.update_one(
-                {"id": user_data.id},
-                {"$set": {"last_online": datetime.now(timezone.utc).isoformat()}}
-            )
             # Return the user data (already has _id excluded)
             return JSONResponse(content=existing_user)
         
@@ -226,7 +280,7 @@ async def session_handler(request: Request, user_data: UserSessionRequest):
             new_user_doc.pop("password_hash", None)
             new_user_doc.pop("salt", None)
             
-            db.users.insert_one(new_user_doc)
+            await db.users.insert_one(new_user_doc)
             
             # Remove the MongoDB _id field before returning
             new_user_doc.pop("_id", None)
@@ -242,42 +296,57 @@ async def get_user_handler(request: Request, id: str = Query(...), token: str =
         # Validate token using environment variable
         verify_token(token)
 
-        user = db.users.find_one({"id": id}, {"_id": 0, "password_hash": 0, "salt": 0})
+        user = await db.users.find_one({"id": id}, {"_id": 0, "password_hash": 0, "salt": 0})
         if not user:
             raise HTTPException(status_code=404, detail=f"User not found: {id}")
-        return user
+        # Documents are already JSON-safe (no _id), so skip jsonable_encoder
+        return JSONResponse(content=user)
 
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get user: {str(e)}")
 
+async def _stream_users(first_batch: list, cursor, pagination: Dict[str, Any]):
+    """Encode an already fetched (non-empty) first batch, then the rest of the
+    cursor, as {"users": [...], "pagination": {...}} one document at a time"""
+    yield b'{"users":['
+    yield b','.join(json.dumps(doc, separators=(",", ":")).encode() for doc in first_batch)
+    async for doc in cursor:
+        yield b',' + json.dumps(doc, separators=(",", ":")).encode()
+    yield b'],"pagination":' + json.dumps(pagination, separators=(",", ":")).encode() + b'}'
+
 async def get_users_handler(request: Request, token: str = Query(...), limit: int = Query(20), offset: int = Query(0)):
     """Get list of users (renamed from get_user_profiles_handler)"""
     try:
         # Validate token using environment variable
         verify_token(token)
 
-        total = db.users.count_documents({})
+        # Unfiltered total comes from collection metadata rather than a scan;
+        # it can lag concurrent inserts/deletes slightly, which is fine for has_more
+        total = await db.users.estimated_document_count()
         users_cursor = db.users.find(
             {}, 
             {"_id": 0, "password_hash": 0, "salt": 0}
         ).skip(offset).limit(limit)
 
-        users_list = list(users_cursor)
-        
         has_more = offset + limit < total
-
-        return {
-            "users": users_list,
-            "pagination": {
-                "total": total,
-                "limit": limit,
-                "offset": offset,
-                "has_more": has_more
-            }
+        pagination = {
+            "total": total,
+            "total_is_estimate": True,
+            "limit": limit,
+            "offset": offset,
+            "has_more": has_more
         }
 
+        # The status goes out before a streamed body, so the first batch is
+        # always read here: a query error still surfaces as an error response.
+        # Only pages larger than that are streamed document by document.
+        first_batch = await users_cursor.to_list(length=STREAM_USERS_OVER)
+        if len(first_batch) < STREAM_USERS_OVER or limit <= STREAM_USERS_OVER:
+            return JSONResponse(content={"users": first_batch, "pagination": pagination})
+        return StreamingResponse(_stream_users(first_batch, users_cursor, pagination), media_type="application/json")
+
     except HTTPException:
         raise
     except Exception as e:
@@ -291,31 +360,28 @@ async def follow_user_handler(request: Request, follow_data: Dict[str, Any]):
         user_id = follow_data.get("user_id")
         target_user_id = follow_data.get("target_user_id")
         
-        # Check if both users exist
-        user = db.users.find_one({"id": user_id})
-        target_user = db.users.find_one({"id": target_user_id})
-        
-        if not user:
-            raise HTTPException(status_code=404, detail=f"User not found: {user_id}")
+        # Only the target's username is needed for the following entry
+        target_user = await db.users.find_one({"id": target_user_id}, {"_id": 0, "username": 1})
         if not target_user:
             raise HTTPException(status_code=404, detail=f"Target user not found: {target_user_id}")
         
-        # Check if already following
-        following = user.get("following", [])
-        if any(f["user_id"] == target_user_id for f in following):
-            return {"success": True, "message": "Already following this user"}
-        
-        # Add to following list
+        # Add to following list; the $ne filter skips users already following
         following_entry = {
             "user_id": target_user_id,
             "username": target_user["username"]
         }
         
-        db.users.update_one(
-            {"id": user_id},
+        result = await db.users.update_one(
+            {"id": user_id, "following.user_id": {"$ne": target_user_id}},
             {"$push": {"following": following_entry}}
         )
         
+        if result.matched_count == 0:
+            # Either the user doesn't exist or already follows the target
+            if not await db.users.find_one({"id": user_id}, {"_id": 1}):
+                raise HTTPException(status_code=404, detail=f"User not found: {user_id}")
+            return {"success": True, "message": "Already following this user"}
+        
         return {"success": True, "message": "User followed successfully"}
         
     except HTTPException:
@@ -332,12 +398,12 @@ async def unfollow_user_handler(request: Request, follow_data: Dict[str, Any]):
         target_user_id = follow_data.get("target_user_id")
         
         # Check if user exists
-        user = db.users.find_one({"id": user_id})
+        user = await db.users.find_one({"id": user_id}, {"_id": 1})
         if not user:
             raise HTTPException(status_code=404, detail=f"User not found: {user_id}")
         
         # Remove from following list
-        db.users.update_one(
+        await db.users.update_one(
             {"id": user_id},
             {"$pull": {"following": {"user_id": target_user_id}}}
         )
@@ -354,23 +420,27 @@ async def search_users_handler(request: Request, token: str = Query(...), query:
     try:
         verify_token(token)
         
-        # Search users by username (case-insensitive)
+        # Case-insensitive username prefix search as a range scan on the
+        # username_ci index. U+FFFF sorts after every character under ICU
+        # collation, so [query, query + U+FFFF) covers all usernames starting
+        # with query. The input is compared, never interpreted as a pattern.
         search_filter = {
-            "username": {"$regex": query, "$options": "i"}
+            "username": {"$gte": query, "$lt": query + "\uffff"}
         }
         
         users_cursor = db.users.find(
             search_filter,
-            {"_id": 0, "password_hash": 0, "salt": 0}
+            {"_id": 0, "password_hash": 0, "salt": 0},
+            collation=USERNAME_SEARCH_COLLATION,
         ).limit(limit)
         
-        users_list = list(users_cursor)
+        users_list = await users_cursor.to_list(length=limit)
         
-        return {
+        return JSONResponse(content={
             "users": users_list,
             "query": query,
             "count": len(users_list)
-        }
+        })
         
     except HTTPException:
         raise
@@ -382,29 +452,28 @@ async def get_followed_users_handler(request: Request, token: str = Query(...),
     try:
         verify_token(token)
         
-        # Get user with following list
-        user = db.users.find_one({"id": user_id}, {"following": 1})
-        if not user:
+        # Join the following list against users server-side in one round trip
+        pipeline = [
+            {"$match": {"id": user_id}},
+            {"$lookup": {
+                "from": "users",
+                "localField": "following.user_id",
+                "foreignField": "id",
+                "as": "followed",
+                "pipeline": [{"$project": {"_id": 0, "password_hash": 0, "salt": 0}}],
+            }},
+            {"$project": {"_id": 0, "followed": 1}},
+        ]
+        result = await (await db.users.aggregate(pipeline)).to_list(length=1)
+        if not result:
             raise HTTPException(status_code=404, detail=f"User not found: {user_id}")
         
-        following = user.get("following", [])
-        followed_user_ids = [f["user_id"] for f in following]
-        
-        if not followed_user_ids:
-            return {"users": [], "count": 0}
+        followed_users = result[0]["followed"]
         
-        # Get full user data for followed users
-        followed_users_cursor = db.users.find(
-            {"id": {"$in": followed_user_ids}},
-            {"_id": 0, "password_hash": 0, "salt": 0}
-        )
-        
-        followed_users = list(followed_users_cursor)
-        
-        return {
+        return JSONResponse(content={
             "users": followed_users,
             "count": len(followed_users)
-        }
+        })
         
     except HTTPException:
         raise
@@ -422,25 +491,21 @@ async def add_to_playlist_handler(request: Request, playlist_data: Dict[str, Any
         if not user_id or not render:
             raise HTTPException(status_code=400, detail="Missing user_id or render data")
         
-        # Check if user exists
-        user = db.users.find_one({"id": user_id})
-        if not user:
-            raise HTTPException(status_code=404, detail=f"User not found: {user_id}")
-        
-        # Check if render already in playlist (prevent duplicates)
-        playlist = user.get("playlist", [])
-        if any(item["id"] == render["id"] for item in playlist):
-            return {"success": True, "message": "Render already in playlist"}
-        
         # Add type field
         render["type"] = "render"
         
-        # Add to playlist
-        db.users.update_one(
-            {"id": user_id},
+        # Add to playlist; the $ne filter prevents duplicates
+        result = await db.users.update_one(
+            {"id": user_id, "playlist.id": {"$ne": render["id"]}},
             {"$push": {"playlist": render}}
         )
         
+        if result.matched_count == 0:
+            # Either the user doesn't exist or the render is already in the playlist
+            if not await db.users.find_one({"id": user_id}, {"_id": 1}):
+                raise HTTPException(status_code=404, detail=f"User not found: {user_id}")
+            return {"success": True, "message": "Render already in playlist"}
+        
         return {"success": True, "message": "Added to playlist"}
         
     except HTTPException:
@@ -460,12 +525,12 @@ async def remove_from_playlist_handler(request: Request, playlist_data: Dict[str
             raise HTTPException(status_code=400, detail="Missing user_id or render_id")
         
         # Check if user exists
-        user = db.users.find_one({"id": user_id})
+        user = await db.users.find_one({"id": user_id}, {"_id": 1})
         if not user:
             raise HTTPException(status_code=404, detail=f"User not found: {user_id}")
         
         # Remove from playlist
-        db.users.update_one(
+        await db.users.update_one(
             {"id": user_id},
             {"$pull": {"playlist": {"id": render_id}}}
         )
@@ -483,16 +548,16 @@ async def get_playlist_handler(request: Request, token: str = Query(...), user_i
         verify_token(token)
         
         # Get user with playlist
-        user = db.users.find_one({"id": user_id}, {"playlist": 1})
+        user = await db.users.find_one({"id": user_id}, {"playlist": 1})
         if not user:
             raise HTTPException(status_code=404, detail=f"User not found: {user_id}")
         
         playlist = user.get("playlist", [])
         
-        return {
+        return JSONResponse(content={
             "playlist": playlist,
             "count": len(playlist)
-        }
+        })
         
     except HTTPException:
         raise
@@ -502,7 +567,29 @@ async def get_playlist_handler(request: Request, token: str = Query(...), user_i
 class UpdateUsernameRequest(BaseModel):
     username: str
 
-async def update_username_handler(request: Request, user_id: str, username_data: UpdateUsernameRequest):
+async def _sync_username_to_threads(user_id: str, username: str):
+    """Sync username to all threads where this user is a participant (runs after the response)"""
+    try:
+        await db.threads.update_many(
+            {"users.id": user_id},  # Find all threads with this user
+            {"$set": {
+                "users.$[elem].username": username,  # Update embedded username
+                "users.$[elem].name": username  # Update embedded name
+            }},
+            array_filters=[{"elem.id": user_id}]  # MongoDB array update syntax
+        )
+    except Exception as e:
+        logger.error(f"Failed to sync username to threads: {e}")
+
+async def _broadcast_username(user_id: str, username: str):
+    """Broadcast username update to online collaborators via WebSocket (runs after the response)"""
+    try:
+        from ws.router import send_user_profile_updated_notification
+        await send_user_profile_updated_notification(user_id, username)
+    except Exception as e:
+        logger.warning(f"Failed to broadcast username update: {e}")
+
+async def update_username_handler(request: Request, user_id: str, username_data: UpdateUsernameRequest, background_tasks: BackgroundTasks):
     """Update user's username"""
     try:
         username = username_data.username.strip()
@@ -511,53 +598,32 @@ async def update_username_handler(request: Request, user_id: str, username_data:
         if len(username) < 3:
             raise HTTPException(status_code=400, detail="Username must be at least 3 characters")
         
-        import re
-        if not re.match(r'^[a-zA-Z0-9_-]+$', username):
+        if not _USERNAME_RE.match(username):
             raise HTTPException(status_code=400, detail="Username can only contain letters, numbers, underscores, and hyphens")
         
-        # Check if user exists
-        user = db.users.find_one({"id": user_id})
-        if not user:
-            raise HTTPException(status_code=404, detail=f"User not found: {user_id}")
-        
-        # Update username in users collection (source of truth)
-        timestamp = datetime.now(timezone.utc).isoformat()
-        db.users.update_one(
+        # Update username in users collection (source of truth) and get the
+        # updated user back (excluding sensitive fields) in the same round-trip
+        updated_user = await db.users.find_one_and_update(
             {"id": user_id},
             {"$set": {
                 "username": username,
                 "name": username,  # Also update name to match username
-                "last_online": timestamp
-            }}
+                "last_online": _now_iso()
+            }},
+            projection={"_id": 0, "password_hash": 0, "salt": 0},
+            return_document=ReturnDocument.AFTER
         )
-        
-        # Sync username to all threads where this user is a participant (denormalized copies)
-        try:
-            db.threads.update_many(
-                {"users.id": user_id},  # Find all threads with this user
-                {"$set": {
-                    "users.$[elem].username": username,  # Update embedded username
-                    "users.$[elem].name": username  # Update embedded name
-                }},
-                array_filters=[{"elem.id": user_id}]  # MongoDB array update syntax
-            )
-        except Exception as e:
-            logger.error(f"Failed to sync username to threads: {e}")
-            # Don't fail the request if thread sync fails
-        
-        # Broadcast username update to online collaborators via WebSocket
-        try:
-            from ws.router import send_user_profile_updated_notification
-            import asyncio
-            await send_user_profile_updated_notification(user_id, username)
-        except Exception as e:
-            logger.warning(f"Failed to broadcast username update: {e}")
-            # Don't fail the request if WebSocket broadcast fails
-        
-        # Return updated user (exclude sensitive fields)
-        updated_user = db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0, "salt": 0})
         if not updated_user:
-            raise HTTPException(status_code=500, detail="Failed to fetch updated user")
+            raise HTTPException(status_code=404, detail=f"User not found: {user_id}")
+        
+        # Drop the cached display name used in invitation notifications
+        from http_api.threads import invalidate_inviter_name
+        invalidate_inviter_name(user_id)
+        
+        # Thread copies and the WebSocket broadcast are updated once the
+        # response is out (tasks run in order, so threads are synced first)
+        background_tasks.add_task(_sync_username_to_threads, user_id, username)
+        background_tasks.add_task(_broadcast_username, user_id, username)
         
         return JSONResponse(content=updated_user, status_code=200)
         
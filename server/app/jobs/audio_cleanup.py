@@ -3,13 +3,90 @@ Audio Cleanup Job
 Deletes unreferenced audio files from S3 after grace period
 """
 
+import asyncio
 import logging
 from datetime import datetime, timedelta
-from db.connection import get_database
+from pymongo import DeleteOne, UpdateOne
+from db.connection import get_async_database, close_async_connection
 from storage.s3_service import get_s3_service
 
 logger = logging.getLogger(__name__)
 
+def _add_counts(totals: tuple, counts: tuple) -> tuple:
+    return tuple(a + b for a, b in zip(totals, counts))
+
+
+def _failed_s3_keys(s3_service, keys: list) -> set:
+    """Delete keys from S3 (on a worker thread); returns the keys that failed"""
+    failed_keys = set()
+    for _, batch_failed in s3_service.delete_files_in_batches(keys):
+        failed_keys |= batch_failed
+    return failed_keys
+
+
+async def _settle_cleanup_batch(db, batch: list, failed_keys: set) -> tuple:
+    """Apply one S3 delete batch's outcome to audio_files
+
+    Args:
+        batch: (s3_key, audio) pairs; s3_key isn't unique, so several
+            records may share a key, and an empty key always counts as failed
+
+    Returns:
+        (deleted, failed, saved_bytes)
+    """
+    deleted = [audio for key, audio in batch if key and key not in failed_keys]
+    failed = [audio for key, audio in batch if not key or key in failed_keys]
+    
+    # Delete from database; S3 delete failed - mark for retry
+    ops = [DeleteOne({"id": a["id"]}) for a in deleted] + [
+        UpdateOne({"id": a["id"]}, {"$set": {"pending_deletion": True}})
+        for a in failed
+    ]
+    try:
+        await db.audio_files.bulk_write(ops, ordered=False)
+    except Exception as e:
+        logger.error("❌ Error settling %s deleted audio records: %s", len(batch), e)
+        return 0, len(batch), 0
+    
+    saved_bytes = 0
+    for audio in deleted:
+        saved_bytes += audio.get("size_bytes", 0)
+        logger.debug("✅ Deleted: %s", audio['url'])
+    for audio in failed:
+        logger.warning("⚠️  S3 delete failed (marked for retry): %s", audio['url'])
+    logger.info("🗑️  Delete batch: %d deleted, %d pending retry", len(deleted), len(failed))
+    return len(deleted), len(failed), saved_bytes
+
+
+async def _delete_audio_batches(db, s3_service, cursor) -> tuple:
+    """Delete the audio files a cursor yields from S3 and audio_files
+
+    Deletes one DeleteObjects batch at a time (on a worker thread), settling
+    the previous batch's records meanwhile. Shared by cleanup and retry.
+
+    Returns:
+        (deleted, failed, saved_bytes)
+    """
+    totals = (0, 0, 0)
+    settling = None
+    while True:
+        chunk = await cursor.to_list(length=1000)
+        if not chunk:
+            break
+        batch = [(audio.get("s3_key") or "", audio) for audio in chunk]
+        # Records without a key are never sent to S3; shared keys go once
+        keys = list(dict.fromkeys(key for key, _ in batch if key))
+        delete_batch = asyncio.to_thread(_failed_s3_keys, s3_service, keys)
+        if settling is None:
+            failed_keys = await delete_batch
+        else:
+            failed_keys, settled = await asyncio.gather(delete_batch, settling)
+            totals = _add_counts(totals, settled)
+        settling = asyncio.create_task(_settle_cleanup_batch(db, batch, failed_keys))
+    if settling is not None:
+        totals = _add_counts(totals, await settling)
+    return totals
+
 
 async def cleanup_unreferenced_audio(
     grace_period_days: int = 30,
@@ -26,81 +103,58 @@ async def cleanup_unreferenced_audio(
         dict: Statistics about cleanup operation
     """
     try:
-        db = get_database()
+        db = get_async_database()
         s3_service = get_s3_service()
         
         # Calculate cutoff date
         cutoff_date = datetime.utcnow() - timedelta(days=grace_period_days)
         cutoff_iso = cutoff_date.isoformat() + "Z"
         
-        # Find candidates for deletion
-        candidates = list(db.audio_files.find({
+        # Count candidates for deletion on the index alone, then stream them
+        candidate_filter = {
             "reference_count": 0,
             "created_at": {"$lt": cutoff_iso}
-        }))
+        }
+        candidate_count = await db.audio_files.count_documents(candidate_filter)
+        candidates = db.audio_files.find(
+            candidate_filter,
+            {"_id": 0, "id": 1, "url": 1, "s3_key": 1, "size_bytes": 1, "created_at": 1}
+        ).batch_size(500)
         
-        logger.info(f"🔍 Found {len(candidates)} unreferenced audio files older than {grace_period_days} days")
+        logger.info("🔍 Found %s unreferenced audio files older than %s days", candidate_count, grace_period_days)
         
         if dry_run:
             logger.info("🧪 DRY RUN - No files will be deleted")
-            for audio in candidates:
-                logger.info(f"   Would delete: {audio['url']} (created: {audio['created_at']})")
+            async for audio in candidates:
+                logger.info("   Would delete: %s (created: %s)", audio['url'], audio['created_at'])
             return {
                 "dry_run": True,
-                "candidates": len(candidates),
+                "candidates": candidate_count,
                 "deleted": 0,
                 "failed": 0,
                 "saved_bytes": 0
             }
         
         # Delete files
-        deleted_count = 0
-        failed_count = 0
-        saved_bytes = 0
-        
-        for audio in candidates:
-            try:
-                # Delete from S3
-                s3_deleted = s3_service.delete_file(audio["s3_key"])
-                
-                if s3_deleted:
-                    # Delete from database
-                    db.audio_files.delete_one({"id": audio["id"]})
-                    
-                    deleted_count += 1
-                    saved_bytes += audio.get("size_bytes", 0)
-                    
-                    logger.info(f"✅ Deleted: {audio['url']}")
-                else:
-                    # S3 delete failed - mark for retry
-                    db.audio_files.update_one(
-                        {"id": audio["id"]},
-                        {"$set": {"pending_deletion": True}}
-                    )
-                    failed_count += 1
-                    logger.warning(f"⚠️  S3 delete failed (marked for retry): {audio['url']}")
-                    
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"❌ Error deleting {audio['url']}: {e}")
+        deleted_count, failed_count, saved_bytes = await _delete_audio_batches(db, s3_service, candidates)
         
         # Log summary
         saved_mb = saved_bytes / (1024 * 1024)
-        logger.info(f"🎉 Cleanup complete:")
-        logger.info(f"   Deleted: {deleted_count} files")
-        logger.info(f"   Failed: {failed_count} files")
-        logger.info(f"   Storage saved: {saved_mb:.2f} MB")
+        logger.info("🎉 Cleanup complete:")
+        logger.info("   Deleted: %s files", deleted_count)
+        logger.info("   Failed: %s files", failed_count)
+        logger.info("   Storage saved: %.2f MB", saved_mb)
         
         return {
             "dry_run": False,
-            "candidates": len(candidates),
+            "candidates": candidate_count,
             "deleted": deleted_count,
             "failed": failed_count,
             "saved_bytes": saved_bytes
         }
         
     except Exception as e:
-        logger.error(f"❌ Audio cleanup job failed: {e}")
+        logger.error("❌ Audio cleanup job failed: %s", e)
         raise
 
 
@@ -112,58 +166,62 @@ async def retry_pending_deletions():
         dict: Statistics about retry operation
     """
     try:
-        db = get_database()
+        db = get_async_database()
         s3_service = get_s3_service()
         
-        # Find files marked for deletion
-        pending = list(db.audio_files.find({"pending_deletion": True}))
-        
-        logger.info(f"🔄 Retrying {len(pending)} pending deletions")
-        
-        deleted_count = 0
-        still_failed = 0
+        # Safety check: only delete if still unreferenced. Files whose
+        # reference count increased are unmarked for deletion in one write
+        unmarked = await db.audio_files.update_many(
+            {"pending_deletion": True, "reference_count": {"$gt": 0}},
+            {"$unset": {"pending_deletion": ""}}
+        )
+        logger.info("↩️  Unmarked %d now-referenced files", unmarked.modified_count)
         
-        for audio in pending:
-            # Safety check: only delete if still unreferenced
-            if audio.get("reference_count", 0) > 0:
-                # Reference count increased - unmark for deletion
-                db.audio_files.update_one(
-                    {"id": audio["id"]},
-                    {"$unset": {"pending_deletion": ""}}
-                )
-                logger.info(f"↩️  Unmarked (now referenced): {audio['url']}")
-                continue
-            
-            try:
-                # Retry S3 deletion
-                s3_deleted = s3_service.delete_file(audio["s3_key"])
-                
-                if s3_deleted:
-                    # Success - delete from database
-                    db.audio_files.delete_one({"id": audio["id"]})
-                    deleted_count += 1
-                    logger.info(f"✅ Retry successful: {audio['url']}")
-                else:
-                    still_failed += 1
-                    logger.warning(f"⚠️  Retry failed again: {audio['url']}")
-                    
-            except Exception as e:
-                still_failed += 1
-                logger.error(f"❌ Retry error for {audio['url']}: {e}")
+        # The rest go through the same batched delete as the cleanup
+        pending = db.audio_files.find(
+            {"pending_deletion": True, "reference_count": {"$not": {"$gt": 0}}},
+            {"_id": 0, "id": 1, "url": 1, "s3_key": 1, "size_bytes": 1}
+        ).batch_size(1000)
+        deleted_count, still_failed, _ = await _delete_audio_batches(db, s3_service, pending)
         
-        logger.info(f"🔄 Retry complete: {deleted_count} deleted, {still_failed} still pending")
+        logger.info("🔄 Retry complete: %s deleted, %s still pending", deleted_count, still_failed)
         
         return {
-            "pending": len(pending),
+            "pending": unmarked.modified_count + deleted_count + still_failed,
             "deleted": deleted_count,
             "still_failed": still_failed
         }
         
     except Exception as e:
-        logger.error(f"❌ Retry pending deletions failed: {e}")
+        logger.error("❌ Retry pending deletions failed: %s", e)
         raise
 
 
+def _reference_stage(array_field: str, source: str) -> list:
+    """Stages emitting one {aid, src} row per (document, referenced audio_file_id)"""
+    return [
+        {"$match": {f"{array_field}.audio_file_id": {"$exists": True}}},
+        # Dedupe per document so each document counts once per audio file
+        {"$project": {"_id": 0, "aid": {"$setUnion": [f"${array_field}.audio_file_id", []]}}},
+        {"$unwind": "$aid"},
+        {"$set": {"src": source}},
+    ]
+
+
+async def _count_references(db) -> dict:
+    """Map audio_file_id -> {"messages": n, "playlists": n} in a single pipeline"""
+    pipeline = _reference_stage("renders", "messages") + [
+        {"$unionWith": {"coll": "users", "pipeline": _reference_stage("playlist", "playlists")}},
+        {"$group": {
+            "_id": "$aid",
+            "messages": {"$sum": {"$cond": [{"$eq": ["$src", "messages"]}, 1, 0]}},
+            "playlists": {"$sum": {"$cond": [{"$eq": ["$src", "playlists"]}, 1, 0]}},
+        }},
+    ]
+    cursor = await db.messages.aggregate(pipeline, allowDiskUse=True)
+    return {doc.pop("_id"): doc async for doc in cursor}
+
+
 async def verify_reference_counts():
     """
     Verify that reference counts match actual usage in messages and playlists
@@ -173,55 +231,58 @@ async def verify_reference_counts():
         dict: Statistics about verification operation
     """
     try:
-        db = get_database()
+        db = get_async_database()
         
         logger.info("🔍 Verifying audio reference counts...")
         
         fixed_count = 0
         verified_count = 0
         errors = []
+        fixes = []
+        
+        # Count actual references in messages and playlists for every audio
+        # file at once (documents referencing each audio_file_id)
+        reference_counts = await _count_references(db)
+        no_refs = {"messages": 0, "playlists": 0}
         
-        for audio in db.audio_files.find({}):
+        async for audio in db.audio_files.find({}, {"_id": 0, "id": 1, "url": 1, "reference_count": 1}).batch_size(1000):
             audio_id = audio["id"]
             stored_count = audio.get("reference_count", 0)
             
             try:
-                # Count actual references in messages
-                message_refs = db.messages.count_documents({
-                    "renders.audio_file_id": audio_id
-                })
-                
-                # Count actual references in playlists
-                playlist_refs = db.users.count_documents({
-                    "playlist.audio_file_id": audio_id
-                })
+                refs = reference_counts.get(audio_id, no_refs)
+                message_refs = refs["messages"]
+                playlist_refs = refs["playlists"]
                 
                 actual_count = message_refs + playlist_refs
                 
                 if actual_count != stored_count:
-                    # Fix drift
-                    db.audio_files.update_one(
+                    # Fix drift (flushed in one bulk write below)
+                    fixes.append(UpdateOne(
                         {"id": audio_id},
                         {"$set": {"reference_count": actual_count}}
-                    )
+                    ))
                     
                     fixed_count += 1
                     logger.warning(
-                        f"⚠️  Fixed reference count drift: {audio['url']}\n"
-                        f"   Stored: {stored_count}, Actual: {actual_count} "
-                        f"(messages: {message_refs}, playlists: {playlist_refs})"
+                        "⚠️  Fixed reference count drift: %s\n"
+                        "   Stored: %d, Actual: %d (messages: %d, playlists: %d)",
+                        audio['url'], stored_count, actual_count, message_refs, playlist_refs
                     )
                 else:
                     verified_count += 1
                     
             except Exception as e:
                 errors.append({"audio_id": audio_id, "error": str(e)})
-                logger.error(f"❌ Error verifying {audio_id}: {e}")
+                logger.error("❌ Error verifying %s: %s", audio_id, e)
+        
+        if fixes:
+            await db.audio_files.bulk_write(fixes, ordered=False)
         
-        logger.info(f"✅ Verification complete:")
-        logger.info(f"   Verified: {verified_count}")
-        logger.info(f"   Fixed: {fixed_count}")
-        logger.info(f"   Errors: {len(errors)}")
+        logger.info("✅ Verification complete:")
+        logger.info("   Verified: %s", verified_count)
+        logger.info("   Fixed: %s", fixed_count)
+        logger.info("   Errors: %s", len(errors))
         
         return {
             "verified": verified_count,
@@ -230,7 +291,7 @@ async def verify_reference_counts():
         }
         
     except Exception as e:
-        logger.error(f"❌ Reference count verification failed: {e}")
+        logger.error("❌ Reference count verification failed: %s", e)
         raise
 
 
@@ -245,37 +306,43 @@ async def find_orphaned_s3_files():
         list: URLs of orphaned S3 files
     """
     try:
-        db = get_database()
+        db = get_async_database()
         s3_service = get_s3_service()
         
         logger.info("🔍 Scanning for orphaned S3 files...")
         
-        # Get all S3 files (this can be slow for large buckets)
-        s3_files = s3_service.list_files(prefix="prod/renders/")
+        # Get all tracked S3 keys; records registered by URL alone have an
+        # empty s3_key, so derive theirs from the bucket's public URL
+        url_prefix = s3_service.get_public_url("")
+        tracked_keys = set()
+        async for audio in db.audio_files.find({}, {"_id": 0, "s3_key": 1, "url": 1}).batch_size(2000):
+            if audio.get("s3_key"):
+                tracked_keys.add(audio["s3_key"])
+            elif audio.get("url", "").startswith(url_prefix):
+                tracked_keys.add(audio["url"][len(url_prefix):])
         
-        # Get all tracked audio file URLs
-        tracked_urls = set()
-        for audio in db.audio_files.find({}, {"url": 1}):
-            tracked_urls.add(audio["url"])
+        # Find orphans, streaming S3 listings a page at a time (this can be
+        # slow for large buckets, so it runs on a worker thread)
+        def scan_listing():
+            orphaned = []
+            for s3_file in s3_service.list_files(prefix="prod/renders/"):
+                if s3_file["key"] not in tracked_keys:
+                    orphaned.append({
+                        "url": s3_service.get_public_url(s3_file["key"]),
+                        "s3_key": s3_file["key"],
+                        "size": s3_file.get("size", 0),
+                        "last_modified": s3_file.get("last_modified")
+                    })
+            return orphaned
         
-        # Find orphans
-        orphaned = []
-        for s3_file in s3_files:
-            s3_url = s3_service.get_public_url(s3_file["key"])
-            if s3_url not in tracked_urls:
-                orphaned.append({
-                    "url": s3_url,
-                    "s3_key": s3_file["key"],
-                    "size": s3_file.get("size", 0),
-                    "last_modified": s3_file.get("last_modified")
-                })
+        orphaned = await asyncio.to_thread(scan_listing)
         
-        logger.info(f"🔍 Found {len(orphaned)} orphaned S3 files")
+        logger.info("🔍 Found %s orphaned S3 files", len(orphaned))
         
         return orphaned
         
     except Exception as e:
-        logger.error(f"❌ Orphan scan failed: {e}")
+        logger.error("❌ Orphan scan failed: %s", e)
         raise
 
 
@@ -316,7 +383,7 @@ async def run_audio_maintenance(
     
     if cleanup:
         logger.info("=" * 60)
-        logger.info(f"Running cleanup (grace period: {grace_period_days} days)...")
+        logger.info("Running cleanup (grace period: %s days)...", grace_period_days)
         logger.info("=" * 60)
         results["cleanup"] = await cleanup_unreferenced_audio(
             grace_period_days=grace_period_days,
@@ -327,7 +394,6 @@ async def run_audio_maintenance(
 
 
 if __name__ == "__main__":
-    import asyncio
     import argparse
     
     # Configure logging
@@ -345,11 +411,17 @@ if __name__ == "__main__":
     
     args = parser.parse_args()
     
-    asyncio.run(run_audio_maintenance(
-        cleanup=not args.skip_cleanup,
-        grace_period_days=args.grace_days,
-        verify=not args.skip_verify,
-        retry=not args.skip_retry,
-        dry_run=args.dry_run
-    ))
+    async def main():
+        try:
+            await run_audio_maintenance(
+                cleanup=not args.skip_cleanup,
+                grace_period_days=args.grace_days,
+                verify=not args.skip_verify,
+                retry=not args.skip_retry,
+                dry_run=args.dry_run
+            )
+        finally:
+            await close_async_connection()
+    
+    asyncio.run(main())
 
@@ -1,10 +1,12 @@
 # main.py
 import sys
 import os
-import threading
 import asyncio
 import uvicorn
-from fastapi import FastAPI, Response
+from contextlib import asynccontextmanager, suppress
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+from pymongo.errors import PyMongoError
 import logging
 from string import Template
 
@@ -14,8 +16,11 @@ sys.path.insert(0, current_dir)
 from http_api.router import router as api_router
 from http_api.deep_links import router as deep_links_router
 from http_api.rate_limiter import RateLimitMiddleware
-from ws.router import start_websocket_server
-from db.init_collections import init_mongodb
+from ws.router import start_websocket_server, init_db as init_ws_db
+from db.init_collections import init_mongodb, validate_sample_data, insert_sample_data
+from db.connection import get_database, close_async_connection
+from http_api.threads import init_db as init_threads_db
+from http_api.users import init_db as init_users_db
 from storage.s3_service import get_s3_service
 
 from dotenv import load_dotenv
@@ -27,33 +32,86 @@ logger = logging.getLogger(__name__)
 api_token = os.getenv("API_TOKEN")
 logger.info(f"🔑 Server loaded API_TOKEN: {api_token}")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Collections and indexes (and an opted-in reinit's drop) are in place
+    # before any request is served; only the seeding runs in the background
+    seed = await asyncio.to_thread(init_database)
+    seed_task = asyncio.create_task(asyncio.to_thread(seed_database)) if seed else None
+    init_threads_db()
+    init_users_db()
+    init_ws_db()
+    
+    # The WebSocket server shares this event loop, so HTTP handlers can
+    # notify its clients directly
+    ws_task = asyncio.create_task(start_websocket_server())
+    
+    logger.info("🚀 Server startup complete!")
+    yield
+    
+    ws_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await ws_task
+    if seed_task is not None:
+        await seed_task
+    await close_async_connection()
+
 app = FastAPI(
     title="API",
-    version="0.0.1"
+    version="0.0.1",
+    lifespan=lifespan
 )
 
 app.add_middleware(RateLimitMiddleware)
 
+@app.exception_handler(PyMongoError)
+async def database_error_handler(request: Request, exc: PyMongoError):
+    """Turn driver errors escaping a handler into the API's 500 response"""
+    logger.error(f"❌ Database error on {request.method} {request.url.path}: {exc}")
+    return JSONResponse(status_code=500, content={"detail": f"Database error: {exc}"})
+
 app.include_router(api_router, prefix="/api/v1", tags=["API v1"])
 app.include_router(deep_links_router, tags=["Deep Linking"])
 
 
-def run_ws_server():
-    asyncio.run(start_websocket_server())
+def init_database() -> bool:
+    """Initialize database collections and indexes.
 
-def init_database():
-    """Initialize database collections"""
+    Returns whether the database was reinitialized and should be seeded
+    (seed_database).
+    """
     try:
         logger.info("🗄️  Initializing database...")
         
-        # Check if this is a stage environment
+        # Wiping and re-seeding is opt-in, and only outside prod
         env = os.getenv("ENV", "prod").lower()
-        s3_folder = os.getenv("S3_FOLDER", "stage/")
+        reinit = os.getenv("REINIT_DB_ON_START", "false").lower() == "true"
+        
+        if not (env in {"dev", "stage"} and reinit):
+            # Keep existing data; just make sure collections and indexes exist
+            init_mongodb(drop_existing=False, insert_samples=False)
+            return False
         
         logger.info("🔄 Reinitializing database (drop existing collections)")
-        init_mongodb(drop_existing=True, insert_samples=True)
+        init_mongodb(drop_existing=True, insert_samples=False)
+        return True
+            
+    except Exception as e:
+        logger.error(f"❌ Database initialization failed: {e}")
+        logger.warning("⚠️  Server starting without database initialization")
+        return False
+
+def seed_database():
+    """Insert sample data after a reinit (and clean the stage S3 folder)"""
+    try:
+        if validate_sample_data():
+            insert_sample_data(get_database())
+        else:
+            logger.error("❌ Sample data validation failed. Skipping sample data.")
         
-        # Cleanup S3 folder if in stage environment
+        # Cleanup S3 folder if in stage environment (its records were just dropped)
+        env = os.getenv("ENV", "prod").lower()
+        s3_folder = os.getenv("S3_FOLDER", "stage/")
         if env == "stage":
             try:
                 logger.info(f"🧹 Stage environment detected - cleaning up S3 folder: {s3_folder}")
@@ -64,17 +122,17 @@ def init_database():
                 logger.warning("⚠️  Continuing with database initialization despite S3 cleanup failure")
             
     except Exception as e:
-        logger.error(f"❌ Database initialization failed: {e}")
-        logger.warning("⚠️  Server starting without database initialization")
-
-@app.on_event("startup")
-def startup_event():
-    init_database()
-    
-    ws_thread = threading.Thread(target=run_ws_server, daemon=True)
-    ws_thread.start()
-    
-    logger.info("🚀 Server startup complete!")
+        logger.error(f"❌ Database seeding failed: {e}")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=5000)
+    # Single worker: the WebSocket server, its client registry and the rate
+    # limiter live in this process. loop/http "auto" pick uvloop/httptools
+    # whenever they are installed.
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=5000,
+        loop="auto",
+        http="auto",
+        access_log=os.getenv("ENV", "prod").lower() != "prod"
+    )
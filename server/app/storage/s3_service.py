@@ -1,13 +1,58 @@
 """S3 Storage Service for Digital Ocean Spaces"""
 import os
+import io
+import asyncio
+import threading
 import boto3
+from collections import deque
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterator, List, Optional, Set, Tuple, Union
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Error codes from endpoints that don't implement DeleteObjects
+BATCH_DELETE_UNSUPPORTED_CODES = {"NotImplemented", "MethodNotAllowed"}
+
+# Parallel single-object deletes when batch delete is unavailable
+DELETE_FALLBACK_WORKERS = 10
+
+# cleanup_folder: concurrent DeleteObjects calls, and how many pages of
+# deletes may be queued before listing waits on the oldest
+CLEANUP_DELETE_WORKERS = 16
+CLEANUP_MAX_INFLIGHT = 32
+
+# Shared botocore settings: a pool big enough for parallel deletes/uploads,
+# short connect / bounded read timeouts so a network blip fails fast into the
+# retries, adaptive retries (client-side throttling on 503 SlowDown) and TCP
+# keepalive
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    connect_timeout=3,
+    read_timeout=30,
+    retries={'mode': 'adaptive', 'max_attempts': 5},
+    tcp_keepalive=True
+)
+
+# Uploads above 8 MB go multipart, 8 MB parts, 10 in flight; smaller files
+# are still sent as a single PUT
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True
+)
+
+# One session per process, so credential/config resolution happens once
+_boto_session = boto3.session.Session()
+
 class S3Service:
+    # Upload ExtraArgs shared by every call; only ContentType varies
+    _BASE_PUT = {'ACL': 'public-read'}
+    
     def __init__(self):
         # Load configuration - exactly as in test script
         self.endpoint_url = os.getenv("S3_ENDPOINT_URL")
@@ -20,44 +65,66 @@ class S3Service:
         if not all([self.endpoint_url, self.access_key, self.secret_key, self.bucket_name]):
             raise ValueError("Missing S3 configuration. Please set S3_ENDPOINT_URL, S3_ACCESS_KEY, S3_SECRET_KEY, and S3_BUCKET_NAME")
         
+        # Public URL prefix: https://BUCKET.REGION.digitaloceanspaces.com/
+        self._url_prefix = f"https://{self.bucket_name}.{self.endpoint_url.split('://', 1)[-1]}/"
+        
         # Initialize boto3 client - exactly as in test script
-        self.client = boto3.client(
+        self.client = _boto_session.client(
             's3',
             endpoint_url=self.endpoint_url,
             aws_access_key_id=self.access_key,
             aws_secret_access_key=self.secret_key,
-            region_name=self.region
+            region_name=self.region,
+            config=S3_CLIENT_CONFIG
         )
         
-        logger.info(f"✅ S3 Service initialized with bucket: {self.bucket_name}")
-        logger.info(f"   Endpoint: {self.endpoint_url}")
-        logger.info(f"   Region: {self.region}")
+        # Flipped off the first time the endpoint rejects DeleteObjects
+        self.batch_delete_supported = True
+        
+        logger.info("✅ S3 Service initialized with bucket: %s", self.bucket_name)
+        logger.info("   Endpoint: %s", self.endpoint_url)
+        logger.info("   Region: %s", self.region)
     
-    def upload_file(self, file_data: bytes, file_key: str, content_type: str = "audio/mpeg") -> Optional[str]:
-        """Upload a file to S3 and return the public URL - matches test script exactly"""
+    def upload_file(self, file_data: Union[bytes, BinaryIO, str], file_key: str, content_type: str = "audio/mpeg") -> Optional[str]:
+        """Upload a file to S3 and return the public URL
+
+        file_data may be bytes, a binary file object (read from its current
+        position - the caller seeks it to 0) or a local path. File objects and
+        paths are streamed, so memory stays bounded by the multipart chunk size.
+        """
         try:
-            # Upload using put_object - exactly as in test script
-            logger.info(f"📤 Uploading file: {file_key}")
-            self.client.put_object(
-                Bucket=self.bucket_name,
-                Key=file_key,
-                Body=file_data,
-                ContentType=content_type,
-                ACL='public-read'
-            )
+            logger.debug("📤 Uploading file: %s", file_key)
+            extra_args = {**self._BASE_PUT, 'ContentType': content_type}
+            if isinstance(file_data, str):
+                self.client.upload_file(
+                    file_data,
+                    self.bucket_name,
+                    file_key,
+                    ExtraArgs=extra_args,
+                    Config=UPLOAD_TRANSFER_CONFIG
+                )
+            else:
+                if isinstance(file_data, (bytes, bytearray)):
+                    file_data = io.BytesIO(file_data)
+                self.client.upload_fileobj(
+                    file_data,
+                    self.bucket_name,
+                    file_key,
+                    ExtraArgs=extra_args,
+                    Config=UPLOAD_TRANSFER_CONFIG
+                )
             
-            # Construct public URL - exactly as in test script
-            public_url = f"https://{self.bucket_name}.{self.endpoint_url.replace('https://', '')}/{file_key}"
-            logger.info(f"✅ Upload successful! Public URL: {public_url}")
+            public_url = self._url_prefix + file_key
+            logger.debug("✅ Upload successful! Public URL: %s", public_url)
             return public_url
             
         except ClientError as e:
-            logger.error(f"❌ S3 Error: {e}")
-            logger.error(f"   Error Code: {e.response.get('Error', {}).get('Code', 'Unknown')}")
-            logger.error(f"   Error Message: {e.response.get('Error', {}).get('Message', 'Unknown')}")
+            logger.error("❌ S3 Error: %s", e)
+            logger.error("   Error Code: %s", e.response.get('Error', {}).get('Code', 'Unknown'))
+            logger.error("   Error Message: %s", e.response.get('Error', {}).get('Message', 'Unknown'))
             return None
         except Exception as e:
-            logger.error(f"❌ Unexpected error during upload: {e}")
+            logger.error("❌ Unexpected error during upload: %s", e)
             return None
     
     def delete_file(self, file_key: str) -> bool:
@@ -67,17 +134,89 @@ class S3Service:
                 Bucket=self.bucket_name,
                 Key=file_key
             )
-            logger.info(f"✅ Deleted file from S3: {file_key}")
+            logger.debug("✅ Deleted file from S3: %s", file_key)
             return True
             
-        except ClientError as e:
-            logger.error(f"❌ Failed to delete file from S3: {e}")
+        except Exception as e:
+            logger.error("❌ Failed to delete file from S3: %s", e)
             return False
     
+    def delete_files_in_batches(self, file_keys: List[str]) -> Iterator[Tuple[List[str], Set[str]]]:
+        """Delete files from S3 with batched DeleteObjects calls (up to 1000 keys each)
+
+        Yields:
+            (batch, failed_keys) for each request, so callers can settle
+            their own records batch by batch
+        """
+        for start in range(0, len(file_keys), 1000):
+            batch = file_keys[start:start + 1000]
+            if not self.batch_delete_supported:
+                yield batch, self._delete_files_parallel(batch)
+                continue
+            try:
+                response = self.client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+                )
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') in BATCH_DELETE_UNSUPPORTED_CODES:
+                    logger.warning("⚠️  Endpoint doesn't support DeleteObjects, falling back to parallel deletes")
+                    self.batch_delete_supported = False
+                    yield batch, self._delete_files_parallel(batch)
+                    continue
+                logger.error("❌ Failed to delete %s files from S3: %s", len(batch), e)
+                yield batch, set(batch)
+                continue
+            except Exception as e:
+                # Timeouts/connection errors (BotoCoreError) and bad keys
+                # (ParamValidationError) fail this batch, not the caller
+                logger.error("❌ Failed to delete %s files from S3: %s", len(batch), e)
+                yield batch, set(batch)
+                continue
+            
+            # Quiet mode only reports failures
+            failed_keys = set()
+            for error in response.get('Errors', []):
+                logger.error("❌ Failed to delete %s: %s", error['Key'], error['Message'])
+                failed_keys.add(error['Key'])
+            yield batch, failed_keys
+    
+    def _delete_files_parallel(self, file_keys: List[str]) -> Set[str]:
+        """Delete files one request each on a bounded worker pool; returns the keys that failed"""
+        with ThreadPoolExecutor(max_workers=DELETE_FALLBACK_WORKERS) as executor:
+            results = list(executor.map(self.delete_file, file_keys))
+        return {key for key, deleted in zip(file_keys, results) if not deleted}
+    
+    def delete_files(self, file_keys: List[str]) -> int:
+        """Delete files from S3 with batched DeleteObjects calls (up to 1000 keys each)
+
+        Returns:
+            int: Number of files deleted
+        """
+        return sum(
+            len(batch) - len(failed_keys)
+            for batch, failed_keys in self.delete_files_in_batches(file_keys)
+        )
+    
+    def list_files(self, prefix: str = "") -> Iterator[dict]:
+        """Yield {key, size, last_modified} for files under prefix, one listing page at a time"""
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(
+            Bucket=self.bucket_name,
+            Prefix=prefix,
+            PaginationConfig={'PageSize': 1000}
+        )
+        for page in pages:
+            for obj in page.get('Contents', ()):
+                yield {
+                    "key": obj['Key'],
+                    "size": obj.get('Size', 0),
+                    "last_modified": obj.get('LastModified')
+                }
+    
     def get_file_url(self, file_key: str) -> str:
         """Get public URL for a file"""
-        # Construct public URL: https://BUCKET.REGION.digitaloceanspaces.com/FILE_KEY
-        return f"https://{self.bucket_name}.{self.endpoint_url.replace('https://', '')}/{file_key}"
+        return self._url_prefix + file_key
     
     def get_public_url(self, file_key: str) -> str:
         """Alias for get_file_url"""
@@ -94,7 +233,7 @@ class S3Service:
         except ClientError as e:
             if e.response['Error']['Code'] == '404':
                 return False
-            logger.error(f"❌ Error checking file existence: {e}")
+            logger.error("❌ Error checking file existence: %s", e)
             return False
     
     def cleanup_folder(self, prefix: str) -> bool:
@@ -108,52 +247,89 @@ class S3Service:
             bool: True if cleanup was successful, False otherwise
         """
         try:
-            logger.info(f"🧹 Starting S3 cleanup for folder: {prefix}")
+            logger.info("🧹 Starting S3 cleanup for folder: %s", prefix)
             
             # List all objects with the given prefix
             paginator = self.client.get_paginator('list_objects_v2')
-            pages = paginator.paginate(Bucket=self.bucket_name, Prefix=prefix)
+            pages = paginator.paginate(
+                Bucket=self.bucket_name,
+                Prefix=prefix,
+                PaginationConfig={'PageSize': 1000}
+            )
+            
+            def settle(future) -> int:
+                # Quiet mode only reports failures
+                errors = future.result().get('Errors', [])
+                for error in errors:
+                    logger.error("❌ Failed to delete %s: %s", error['Key'], error['Message'])
+                return len(errors)
             
-            deleted_count = 0
-            for page in pages:
-                if 'Contents' not in page:
-                    logger.info(f"✅ No files found in {prefix}")
-                    return True
-                
-                # Prepare batch delete (max 1000 objects per request)
-                objects_to_delete = [{'Key': obj['Key']} for obj in page['Contents']]
-                
-                if objects_to_delete:
-                    response = self.client.delete_objects(
+            listed_count = 0
+            failed_count = 0
+            # Delete each listed page (max 1000 objects per request) on the
+            # pool while the next page is listed, draining the oldest request
+            # once too many are in flight
+            inflight = deque()
+            with ThreadPoolExecutor(max_workers=CLEANUP_DELETE_WORKERS) as executor:
+                for page in pages:
+                    objects_to_delete = [{'Key': obj['Key']} for obj in page.get('Contents', ())]
+                    if not objects_to_delete:
+                        continue
+                    if len(inflight) >= CLEANUP_MAX_INFLIGHT:
+                        failed_count += settle(inflight.popleft())
+                    inflight.append(executor.submit(
+                        self.client.delete_objects,
                         Bucket=self.bucket_name,
-                        Delete={'Objects': objects_to_delete}
-                    )
-                    
-                    deleted_count += len(objects_to_delete)
-                    
-                    if 'Errors' in response:
-                        for error in response['Errors']:
-                            logger.error(f"❌ Failed to delete {error['Key']}: {error['Message']}")
+                        Delete={'Objects': objects_to_delete, 'Quiet': True}
+                    ))
+                    listed_count += len(objects_to_delete)
+                while inflight:
+                    failed_count += settle(inflight.popleft())
             
-            logger.info(f"✅ S3 cleanup complete! Deleted {deleted_count} files from {prefix}")
+            if not listed_count:
+                logger.info("✅ No files found in %s", prefix)
+                return True
+            
+            logger.info("✅ S3 cleanup complete! Deleted %s files from %s", listed_count - failed_count, prefix)
             return True
             
         except ClientError as e:
-            logger.error(f"❌ S3 cleanup failed: {e}")
-            logger.error(f"   Error Code: {e.response.get('Error', {}).get('Code', 'Unknown')}")
-            logger.error(f"   Error Message: {e.response.get('Error', {}).get('Message', 'Unknown')}")
+            logger.error("❌ S3 cleanup failed: %s", e)
+            logger.error("   Error Code: %s", e.response.get('Error', {}).get('Code', 'Unknown'))
+            logger.error("   Error Message: %s", e.response.get('Error', {}).get('Message', 'Unknown'))
             return False
         except Exception as e:
-            logger.error(f"❌ Unexpected error during S3 cleanup: {e}")
+            logger.error("❌ Unexpected error during S3 cleanup: %s", e)
             return False
 
-# Global instance
+    # Async wrappers: boto3 is blocking, so coroutines run these calls on a
+    # worker thread instead of stalling the event loop
+    async def aupload_file(self, file_data: Union[bytes, BinaryIO, str], file_key: str, content_type: str = "audio/mpeg") -> Optional[str]:
+        return await asyncio.to_thread(self.upload_file, file_data, file_key, content_type)
+    
+    async def adelete_file(self, file_key: str) -> bool:
+        return await asyncio.to_thread(self.delete_file, file_key)
+    
+    async def adelete_files(self, file_keys: List[str]) -> int:
+        return await asyncio.to_thread(self.delete_files, file_keys)
+    
+    async def afile_exists(self, file_key: str) -> bool:
+        return await asyncio.to_thread(self.file_exists, file_key)
+    
+    async def acleanup_folder(self, prefix: str) -> bool:
+        return await asyncio.to_thread(self.cleanup_folder, prefix)
+
+# Global instance; the lock keeps worker threads racing on first use from
+# each building a client (and connection pool) of their own
 _s3_service: Optional[S3Service] = None
+_s3_service_lock = threading.Lock()
 
 def get_s3_service() -> S3Service:
     """Get or create S3 service instance"""
     global _s3_service
     if _s3_service is None:
-        _s3_service = S3Service()
+        with _s3_service_lock:
+            if _s3_service is None:
+                _s3_service = S3Service()
     return _s3_service
 
@@ -1,3 +1,4 @@
+import re
 import asyncio
 import websockets
 import json
@@ -8,7 +9,10 @@ import os
 from datetime import datetime
 from typing import Optional, Dict, Any
 from bson import ObjectId
-from db.connection import get_database
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from db.connection import get_async_database
+from http_api.auth import API_TOKEN_BYTES, _token_ok
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,41 +24,198 @@ print(f"🔑 WebSocket server loaded API_TOKEN: {API_TOKEN}")
 MAX_CONNECTIONS_PER_MINUTE = 10
 MAX_TOTAL_CLIENTS = 100
 MAX_MESSAGE_RATE = 60
+# Rate-limit windows (seconds) and how many keys each table may track before
+# expired windows are swept
+RATE_LIMIT_WINDOW = 60
+MAX_RATE_LIMIT_KEYS = 100_000
 
 # State
 clients = {}  # Maps user IDs to WebSocket connections
-client_message_rates = defaultdict(lambda: {'count': 0, 'reset_time': time.time() + 60})
-connection_attempts = defaultdict(lambda: {'count': 0, 'reset_time': time.time() + 60})
+# Rate-limit tables: key -> [count, reset_time]; expired windows are evicted
+client_message_rates: Dict[str, list] = {}
+connection_attempts: Dict[str, list] = {}
 
 # Chat storage: maps (user1, user2) tuple to list of messages
 chats = defaultdict(list)
 
-# Database
-db = get_database()
+# Encoded chat_history replies by (requester, with_user): (expires_at, payload)
+CHAT_HISTORY_TTL = 5.0
+CHAT_HISTORY_CACHE_MAX = 10_000
+_history_cache: Dict[tuple, tuple] = {}
+
+# Database: the async client, bound on app startup (init_db)
+db = None
+
+def init_db():
+    """Bind the module's database handle to this process's async client"""
+    set_db(get_async_database())
+
+def set_db(database):
+    """Rebind the module's database handle (e.g. to point tests at another database)"""
+    global db
+    db = database
 
 # --- Utility Functions ---
 
 def is_valid_token(token):
-    return token == API_TOKEN
+    # Same cached constant-time check as the HTTP API; an unset API_TOKEN
+    # rejects everything
+    return bool(API_TOKEN_BYTES) and isinstance(token, str) and _token_ok(token)
 
 def sanitize_input(text):
     if not isinstance(text, str):
         return ""
     return text.replace('\x00', '').strip()[:1000]
 
+_HEX24_RE = re.compile(r'[0-9a-fA-F]{24}\Z')
+
 def is_hex24(value: str) -> bool:
-    if not isinstance(value, str) or len(value) != 24:
-        return False
-    try:
-        int(value, 16)
-        return True
-    except Exception:
-        return False
+    # Regex match instead of int(value, 16), which also let through "0x",
+    # "_" and surrounding whitespace
+    return isinstance(value, str) and _HEX24_RE.match(value) is not None
 
 def now_iso() -> str:
     return datetime.utcnow().isoformat() + "Z"
 
-def persist_message_document(*, user_id: str, parent_thread: Optional[str], metadata: Dict[str, Any], snapshot: Optional[Dict[str, Any]] = None) -> str:
+# --- Write-behind Message Persistence ---
+
+# Messages are acknowledged with a pre-minted id and written behind: a single
+# worker collects writes for MESSAGE_WRITE_DELAY seconds and flushes up to
+# MESSAGE_WRITE_BATCH of them with one insert_many and one bulk_write. Failed
+# writes are requeued (after MESSAGE_WRITE_RETRY_DELAY) up to
+# MESSAGE_WRITE_ATTEMPTS times before being dropped.
+MESSAGE_WRITE_BATCH = 500
+MESSAGE_WRITE_DELAY = 0.05
+MESSAGE_WRITE_ATTEMPTS = 5
+MESSAGE_WRITE_RETRY_DELAY = 1.0
+# Same cap the HTTP writers keep threads' recent_messages copies at
+RECENT_MESSAGES_CAP = 100
+_message_write_queue: Optional[asyncio.Queue] = None
+_message_writer: Optional[asyncio.Task] = None
+
+def _failed_writes(e: Exception, entries: list) -> list:
+    """Entries of a failed unordered write worth retrying.
+
+    On a BulkWriteError only the ops that errored are retried, minus
+    duplicate keys (already written by an earlier attempt); any other error
+    leaves the outcome unknown, so everything is retried.
+    """
+    if isinstance(e, BulkWriteError):
+        return [
+            entries[error["index"]] for error in e.details.get("writeErrors", [])
+            if error.get("code") != 11000
+        ]
+    return entries
+
+async def _write_message_batch(batch) -> list:
+    """Insert queued message docs, then push their ids onto their threads.
+    Returns the queue entries that failed and should be retried.
+    """
+    inserts = [entry for entry in batch if entry[0] == "insert"]
+    pushes: Dict[str, list] = {}
+    for entry in batch:
+        if entry[0] == "push":
+            pushes.setdefault(entry[1][0], []).append(entry)
+    retry = []
+    if inserts:
+        try:
+            await db.messages.insert_many([entry[1] for entry in inserts], ordered=False)
+        except Exception as e:
+            logger.error(f"Failed to persist {len(inserts)} message(s): {e}")
+            retry += _failed_writes(e, inserts)
+        # A history read may have cached the pair before the write landed
+        for _, doc, _ in inserts:
+            if doc.get("parent_thread") is None and doc["metadata"].get("to"):
+                invalidate_chat_history(doc["user_id"], doc["metadata"]["to"])
+    if pushes:
+        updated_at = now_iso()
+        # First attempts share one op per thread; a retried push may already
+        # have landed, so each gets its own op guarded on its id (matching
+        # nothing if it's already there) and can't hold back the others
+        ops, op_entries = [], []
+        for thread_id, entries in pushes.items():
+            fresh = [entry for entry in entries if entry[2] == 0]
+            groups = ([fresh] if fresh else []) + [[entry] for entry in entries if entry[2] > 0]
+            for group in groups:
+                recent = [entry[1][1] for entry in group]
+                message_ids = [message["id"] for message in recent]
+                query = {"id": thread_id}
+                if group is not fresh:
+                    query["messages"] = {"$ne": message_ids[0]}
+                ops.append(UpdateOne(query, {
+                    "$push": {
+                        "messages": {"$each": message_ids},
+                        "recent_messages": {"$each": recent, "$slice": -RECENT_MESSAGES_CAP},
+                    },
+                    "$set": {"updated_at": updated_at}
+                }))
+                op_entries.append(group)
+        try:
+            await db.threads.bulk_write(ops, ordered=False)
+        except Exception as e:
+            logger.error(f"Failed to push messages to {len(pushes)} thread(s): {e}")
+            for entries in _failed_writes(e, op_entries):
+                retry += entries
+    return retry
+
+def _requeue_message_writes(queue: asyncio.Queue, entries: list) -> None:
+    dropped = 0
+    for kind, item, attempts in entries:
+        if attempts + 1 < MESSAGE_WRITE_ATTEMPTS:
+            queue.put_nowait((kind, item, attempts + 1))
+        else:
+            dropped += 1
+    if dropped:
+        logger.error(f"Dropped {dropped} message write(s) after {MESSAGE_WRITE_ATTEMPTS} attempts")
+
+def _drain_message_writes(queue: asyncio.Queue) -> list:
+    batch = []
+    while len(batch) < MESSAGE_WRITE_BATCH and not queue.empty():
+        batch.append(queue.get_nowait())
+        queue.task_done()
+    return batch
+
+async def _message_writer_loop(queue: asyncio.Queue):
+    while True:
+        batch = [await queue.get()]
+        queue.task_done()
+        try:
+            await asyncio.sleep(MESSAGE_WRITE_DELAY)
+        finally:
+            # Also on cancellation, so a batch already taken isn't dropped
+            batch += _drain_message_writes(queue)
+            retry = await _write_message_batch(batch)
+            _requeue_message_writes(queue, retry)
+        if retry:
+            # Give Mongo a moment before the failed writes come round again
+            await asyncio.sleep(MESSAGE_WRITE_RETRY_DELAY)
+
+def _enqueue_message_write(kind: str, item) -> None:
+    global _message_write_queue, _message_writer
+    if _message_writer is None or _message_writer.done():
+        _message_write_queue = asyncio.Queue()
+        _message_writer = asyncio.get_running_loop().create_task(
+            _message_writer_loop(_message_write_queue)
+        )
+    _message_write_queue.put_nowait((kind, item, 0))
+
+async def flush_message_writes() -> None:
+    """Stop the writer and write whatever is still queued (server shutdown)"""
+    global _message_writer
+    if _message_writer is None:
+        return
+    writer, _message_writer = _message_writer, None
+    writer.cancel()
+    try:
+        await writer
+    except asyncio.CancelledError:
+        pass
+    while batch := _drain_message_writes(_message_write_queue):
+        retry = await _write_message_batch(batch)
+        _requeue_message_writes(_message_write_queue, retry)
+
+def persist_message_document(*, user_id: str, parent_thread: Optional[str], metadata: Dict[str, Any], snapshot: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Queue a message for writing; returns the document (its id is pre-minted)"""
     message_id = str(ObjectId())
     doc: Dict[str, Any] = {
         "schema_version": 1,
@@ -67,55 +228,77 @@ def persist_message_document(*, user_id: str, parent_thread: Optional[str], meta
     }
     if snapshot is not None:
         doc["snapshot"] = snapshot
-    db.messages.insert_one(doc)
-    return message_id
+    _enqueue_message_write("insert", doc)
+    return doc
 
-def push_message_to_thread(thread_id: str, message_id: str) -> None:
+def push_message_to_thread(thread_id: str, message: Dict[str, Any]) -> None:
+    """Queue appending a persisted message to its thread's messages and recent_messages"""
     if not is_hex24(thread_id):
         return
-    db.threads.update_one({"id": thread_id}, {
-        "$push": {"messages": message_id},
-        "$set": {"updated_at": now_iso()}
-    })
+    recent_message = {k: v for k, v in message.items() if k not in ("snapshot", "_id")}
+    _enqueue_message_write("push", (thread_id, recent_message))
+
+# Compact, non-ASCII-escaping encoder built once for every outbound frame
+_encode_json = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
 
 async def send_json(websocket, data, timeout=5.0):
+    """Send data as a JSON text frame; pass a str to reuse an already encoded payload.
+    Returns whether the frame was sent.
+    """
     try:
-        await asyncio.wait_for(websocket.send(json.dumps(data)), timeout=timeout)
+        if not isinstance(data, str):
+            data = _encode_json(data)
+        await asyncio.wait_for(websocket.send(data), timeout=timeout)
+        return True
     except Exception as e:
         logger.debug(f"Failed to send message: {e}")
+        return False
+
+async def send_to_users(user_ids, payload: str) -> int:
+    """Send an encoded payload to every online user in user_ids concurrently.
+    Returns number of recipients it was delivered to.
+    """
+    targets = [ws for ws in map(clients.get, user_ids) if ws]
+    if not targets:
+        return 0
+    results = await asyncio.gather(*(send_json(ws, payload) for ws in targets), return_exceptions=True)
+    return sum(result is True for result in results)
 
 async def send_error(websocket, error_msg):
     await send_json(websocket, {"type": "error", "message": error_msg})
 
 # --- Rate Limiting ---
 
-def check_connection_rate_limit(client_ip):
-    current_time = time.time()
-    client_limit = connection_attempts[client_ip]
+def prune_rate_limits(table, current_time=None):
+    """Drop keys whose window has expired"""
+    current_time = current_time or time.time()
+    for key in [k for k, (_, reset_time) in table.items() if current_time > reset_time]:
+        del table[key]
 
-    if current_time > client_limit['reset_time']:
-        client_limit['count'] = 0
-        client_limit['reset_time'] = current_time + 60
+def _check_rate_limit(table, key, limit):
+    current_time = time.time()
+    client_limit = table.get(key)
+
+    if client_limit is None or current_time > client_limit[1]:
+        if client_limit is None and len(table) >= MAX_RATE_LIMIT_KEYS:
+            prune_rate_limits(table, current_time)
+            if len(table) >= MAX_RATE_LIMIT_KEYS:
+                # Every window is live: refuse new keys rather than grow
+                return False
+        table[key] = [1, current_time + RATE_LIMIT_WINDOW]
+        return True
 
-    if client_limit['count'] >= MAX_CONNECTIONS_PER_MINUTE:
+    if client_limit[0] >= limit:
         return False
 
-    client_limit['count'] += 1
+    client_limit[0] += 1
     return True
 
-def check_message_rate_limit(client_id):
-    current_time = time.time()
-    client_limit = client_message_rates[client_id]
-
-    if current_time > client_limit['reset_time']:
-        client_limit['count'] = 0
-        client_limit['reset_time'] = current_time + 60
-
-    if client_limit['count'] >= MAX_MESSAGE_RATE:
-        return False
+def check_connection_rate_limit(client_ip):
+    return _check_rate_limit(connection_attempts, client_ip, MAX_CONNECTIONS_PER_MINUTE)
 
-    client_limit['count'] += 1
-    return True
+def check_message_rate_limit(client_id):
+    return _check_rate_limit(client_message_rates, client_id, MAX_MESSAGE_RATE)
 
 # --- Authentication ---
 
@@ -194,6 +377,30 @@ def get_chat_history(user1, user2):
     key = chat_key(user1, user2)
     return chats.get(key, [])
 
+def _cached_history(client_id, with_user) -> Optional[str]:
+    entry = _history_cache.get((client_id, with_user))
+    if entry is None:
+        return None
+    if entry[0] <= time.monotonic():
+        del _history_cache[(client_id, with_user)]
+        return None
+    return entry[1]
+
+def _cache_history(client_id, with_user, payload: str) -> None:
+    now = time.monotonic()
+    if len(_history_cache) >= CHAT_HISTORY_CACHE_MAX:
+        # Drop expired entries; if they're all fresh start over
+        for key in [k for k, (expires_at, _) in _history_cache.items() if expires_at <= now]:
+            del _history_cache[key]
+        if len(_history_cache) >= CHAT_HISTORY_CACHE_MAX:
+            _history_cache.clear()
+    _history_cache[(client_id, with_user)] = (now + CHAT_HISTORY_TTL, payload)
+
+def invalidate_chat_history(user1, user2) -> None:
+    """Drop both sides' cached history after a new direct message"""
+    _history_cache.pop((user1, user2), None)
+    _history_cache.pop((user2, user1), None)
+
 # --- Message Handling ---
 
 async def handle_direct_message(websocket, client_id, message):
@@ -211,12 +418,9 @@ async def handle_direct_message(websocket, client_id, message):
         await send_error(websocket, "Target ID must be a 24-character hex string")
         return
     metadata = {"to": target_id, "content": real_msg}
-    try:
-        message_id = persist_message_document(user_id=client_id, parent_thread=None, metadata=metadata)
-    except Exception as e:
-        logger.error(f"Failed to persist direct message: {e}")
-        await send_error(websocket, "Failed to store message")
-        return
+    # Written behind; the ack only confirms the message was accepted
+    message_id = persist_message_document(user_id=client_id, parent_thread=None, metadata=metadata)["id"]
+    invalidate_chat_history(client_id, target_id)
 
     target_ws = clients.get(target_id)
     if target_ws:
@@ -234,7 +438,7 @@ async def handle_direct_message(websocket, client_id, message):
     await send_json(websocket, {
         "type": "delivered",
         "to": target_id,
-        "message": "Message stored and sent (if user online)",
+        "message": "Message accepted and sent (if user online)",
         "message_id": message_id
     })
 
@@ -256,6 +460,11 @@ async def handle_special_command(websocket, client_id, message_obj):
             if not is_hex24(with_user):
                 await send_error(websocket, "User ID must be a 24-character hex string")
                 return True
+            # Reopening the same chat within a few seconds reuses the encoded reply
+            payload = _cached_history(client_id, with_user)
+            if payload is not None:
+                await send_json(websocket, payload)
+                return True
             cursor = db.messages.find(
                 {
                     "$or": [
@@ -266,12 +475,14 @@ async def handle_special_command(websocket, client_id, message_obj):
                 },
                 {"_id": 0}
             ).sort("created_at", -1).limit(100)
-            history = list(cursor)
-            await send_json(websocket, {
+            history = await cursor.to_list(length=100)
+            payload = _encode_json({
                 "type": "chat_history",
                 "with": with_user,
                 "messages": history
             })
+            _cache_history(client_id, with_user, payload)
+            await send_json(websocket, payload)
         except Exception as e:
             logger.error(f"Failed to load chat history: {e}")
             await send_error(websocket, "Failed to load chat history")
@@ -326,19 +537,15 @@ async def handle_special_command(websocket, client_id, message_obj):
             await send_error(websocket, "IDs must be 24-character hex strings")
             return True
             
-        # Persist message with parent_thread = thread_id
-        try:
-            metadata = {
-                "target_user": target_user,
-                "thread_title": thread_title,
-                "event": "thread_message"
-            }
-            message_id = persist_message_document(user_id=client_id, parent_thread=thread_id, metadata=metadata)
-            push_message_to_thread(thread_id, message_id)
-        except Exception as e:
-            logger.error(f"Failed to persist thread message: {e}")
-            await send_error(websocket, "Failed to store thread message")
-            return True
+        # Persist message with parent_thread = thread_id (written behind)
+        metadata = {
+            "target_user": target_user,
+            "thread_title": thread_title,
+            "event": "thread_message"
+        }
+        message = persist_message_document(user_id=client_id, parent_thread=thread_id, metadata=metadata)
+        push_message_to_thread(thread_id, message)
+        message_id = message["id"]
         
         # Send real-time notification to target user if online
         target_ws = clients.get(target_user)
@@ -479,10 +686,14 @@ def is_user_online(user_id):
 # --- Entry Point ---
 
 async def heartbeat_loop():
-    """Clean up stale connections every 60 seconds"""
+    """Clean up stale connections and expired rate-limit windows every 60 seconds"""
     while True:
         await asyncio.sleep(60)
         
+        # Forget rate-limit windows that have run out
+        prune_rate_limits(connection_attempts)
+        prune_rate_limits(client_message_rates)
+        
         if not clients:
             continue
         
@@ -517,46 +728,90 @@ async def start_websocket_server():
     logger.info("Starting WebSocket server at ws://0.0.0.0:8765")
     
     # Start heartbeat task
-    asyncio.create_task(heartbeat_loop())
+    heartbeat_task = asyncio.create_task(heartbeat_loop())
     logger.info("Started heartbeat loop for online status")
     
-    async with websockets.serve(
-        handler,
-        "0.0.0.0",
-        8765,
-        close_timeout=10,
-        max_size=2**20,
-        max_queue=32,
-        compression=None,
-        ping_interval=20,
-        ping_timeout=10
-    ):
-        await asyncio.Future()
+    try:
+        async with websockets.serve(
+            handler,
+            "0.0.0.0",
+            8765,
+            close_timeout=10,
+            max_size=2**20,
+            max_queue=32,
+            compression=None,
+            ping_interval=20,
+            ping_timeout=10
+        ):
+            await asyncio.Future()
+    finally:
+        # Cancelled on app shutdown; stop the heartbeat with the server and
+        # write out any messages still queued
+        heartbeat_task.cancel()
+        await flush_message_writes()
 
 # --- Out-of-band Notifications (used by HTTP API) ---
 
+# HTTP handlers enqueue notifications here instead of creating a task per
+# notification; a single long-lived dispatcher drains the queue and runs up to
+# NOTIFICATION_CONCURRENCY of them at once, so one slow socket or thread
+# doesn't hold up the others
+NOTIFICATION_CONCURRENCY = 32
+_notification_queue: Optional[asyncio.Queue] = None
+_notification_worker: Optional[asyncio.Task] = None
+
+async def _dispatch_notification(slots: asyncio.Semaphore, queue: asyncio.Queue, send, args):
+    try:
+        await send(*args)
+    except Exception as e:
+        logger.error(f"Notification dispatch failed: {e}")
+    finally:
+        slots.release()
+        queue.task_done()
+
+async def _notification_worker_loop(queue: asyncio.Queue):
+    slots = asyncio.Semaphore(NOTIFICATION_CONCURRENCY)
+    # Strong references to running sends (the loop only keeps weak ones)
+    running = set()
+    while True:
+        send, args = await queue.get()
+        await slots.acquire()
+        task = asyncio.create_task(_dispatch_notification(slots, queue, send, args))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+def _enqueue_notification(send, *args) -> None:
+    """Queue a notification coroutine function for the worker on the running loop"""
+    global _notification_queue, _notification_worker
+    if _notification_worker is None or _notification_worker.done():
+        _notification_queue = asyncio.Queue()
+        _notification_worker = asyncio.get_running_loop().create_task(
+            _notification_worker_loop(_notification_queue)
+        )
+    _notification_queue.put_nowait((send, args))
+
+def enqueue_message_created(thread_id: str, message_doc: Dict[str, Any]) -> None:
+    """Fire-and-forget variant of send_message_created_notification"""
+    _enqueue_notification(send_message_created_notification, thread_id, message_doc)
+
+def enqueue_invitation_accepted(thread_id: str, accepted_user_id: str, accepted_user_name: str, invited_by: Optional[str]) -> None:
+    """Fire-and-forget variant of send_invitation_accepted_notification"""
+    _enqueue_notification(send_invitation_accepted_notification, thread_id, accepted_user_id, accepted_user_name, invited_by)
+
 async def send_message_created_notification(thread_id: str, message_doc: Dict[str, Any]) -> int:
     """Broadcast a newly created message to all online members of the thread.
     Returns number of recipients notified.
     """
     try:
-        thread = db.threads.find_one({"id": thread_id})
+        thread = await db.threads.find_one({"id": thread_id}, {"_id": 0, "users.id": 1})
         if not thread:
             return 0
         recipients = [u.get("id") for u in thread.get("users", []) if isinstance(u, dict) and u.get("id")]
         sender_id = message_doc.get("user_id")
         recipients = [uid for uid in recipients if uid != sender_id]
-        delivered = 0
-        for user_id in recipients:
-            ws = clients.get(user_id)
-            if ws:
-                try:
-                    payload = {"type": "message_created", **message_doc}
-                    await send_json(ws, payload)
-                    delivered += 1
-                except Exception:
-                    pass
-        return delivered
+        # One payload for every recipient; the message doc may carry a large snapshot
+        payload = _encode_json({"type": "message_created", **message_doc})
+        return await send_to_users(recipients, payload)
     except Exception:
         return 0
 
@@ -565,7 +820,7 @@ async def send_invitation_accepted_notification(thread_id: str, accepted_user_id
     Sends complete participant list with current online status for immediate UI update.
     """
     try:
-        thread = db.threads.find_one({"id": thread_id})
+        thread = await db.threads.find_one({"id": thread_id}, {"_id": 0, "users": 1})
         if not thread:
             return 0
         
@@ -595,22 +850,16 @@ async def send_invitation_accepted_notification(thread_id: str, accepted_user_id
             if invited_by != accepted_user_id:
                 recipients.add(invited_by)
         
-        delivered = 0
-        for user_id in recipients:
-            ws = clients.get(user_id)
-            if ws:
-                try:
-                    await send_json(ws, {
-                        "type": "invitation_accepted",
-                        "thread_id": thread_id,
-                        "user_id": accepted_user_id,
-                        "user_name": accepted_user_name,
-                        "participants": all_participants,  # Send complete list with online status
-                        "timestamp": int(time.time())
-                    })
-                    delivered += 1
-                except Exception:
-                    pass
+        # Encoded once for every recipient
+        payload = _encode_json({
+            "type": "invitation_accepted",
+            "thread_id": thread_id,
+            "user_id": accepted_user_id,
+            "user_name": accepted_user_name,
+            "participants": all_participants,  # Send complete list with online status
+            "timestamp": int(time.time())
+        })
+        delivered = await send_to_users(recipients, payload)
         
         logger.info(f"  Delivered invitation_accepted to {delivered}/{len(recipients)} recipients")
         return delivered
@@ -624,8 +873,8 @@ async def send_user_profile_updated_notification(user_id: str, username: str) ->
     """
     try:
         # Find all threads where this user is a participant
-        threads_cursor = db.threads.find({"users.id": user_id}, {"id": 1, "users": 1})
-        threads = list(threads_cursor)
+        threads_cursor = db.threads.find({"users.id": user_id}, {"_id": 0, "users.id": 1})
+        threads = await threads_cursor.to_list(length=None)
         
         if not threads:
             logger.info(f"User {user_id} is not in any threads, no notifications sent")
@@ -643,20 +892,13 @@ async def send_user_profile_updated_notification(user_id: str, username: str) ->
             return 0
         
         # Send notification to all online recipients
-        delivered = 0
-        for recipient_id in recipient_ids:
-            ws = clients.get(recipient_id)
-            if ws:
-                try:
-                    await send_json(ws, {
-                        "type": "user_profile_updated",
-                        "user_id": user_id,
-                        "username": username,
-                        "timestamp": int(time.time())
-                    })
-                    delivered += 1
-                except Exception as e:
-                    logger.error(f"Failed to send user_profile_updated to {recipient_id}: {e}")
+        payload = _encode_json({
+            "type": "user_profile_updated",
+            "user_id": user_id,
+            "username": username,
+            "timestamp": int(time.time())
+        })
+        delivered = await send_to_users(recipient_ids, payload)
         
         logger.info(f"Broadcasted username update for {user_id} to {delivered}/{len(recipient_ids)} online user(s)")
         return delivered
@@ -675,8 +917,8 @@ async def broadcast_user_status_change(user_id: str, is_online: bool) -> int:
     """
     try:
         # Find all threads where this user is a participant
-        threads_cursor = db.threads.find({"users.id": user_id}, {"id": 1, "users": 1})
-        threads = list(threads_cursor)
+        threads_cursor = db.threads.find({"users.id": user_id}, {"_id": 0, "users.id": 1})
+        threads = await threads_cursor.to_list(length=None)
         
         if not threads:
             logger.debug(f"User {user_id} is not in any threads, no status broadcast needed")
@@ -694,21 +936,14 @@ async def broadcast_user_status_change(user_id: str, is_online: bool) -> int:
             return 0
         
         # Send status change notification to all online recipients
-        delivered = 0
+        payload = _encode_json({
+            "type": "user_status_changed",
+            "user_id": user_id,
+            "is_online": is_online,
+            "timestamp": int(time.time())
+        })
+        delivered = await send_to_users(recipient_ids, payload)
         status_text = "online" if is_online else "offline"
-        for recipient_id in recipient_ids:
-            ws = clients.get(recipient_id)
-            if ws:
-                try:
-                    await send_json(ws, {
-                        "type": "user_status_changed",
-                        "user_id": user_id,
-                        "is_online": is_online,
-                        "timestamp": int(time.time())
-                    })
-                    delivered += 1
-                except Exception as e:
-                    logger.error(f"Failed to send status change to {recipient_id}: {e}")
         
         logger.info(f"Broadcasted user {user_id} went {status_text} to {delivered}/{len(recipient_ids)} online user(s)")
         return delivered